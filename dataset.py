@@ -1,6 +1,11 @@
 from typing import Tuple, List, Union, Optional, Dict, Any
 
 import functools
+import hashlib
+import json
+import os
+import shutil
+from itertools import chain
 import numpy as np
 import pandas as pd
 import random
@@ -14,6 +19,55 @@ from mars_gym.data.dataset import (
     InteractionsWithNegativeItemGenerationDataset,
 )
 
+TRIPLET_STORE_META = "meta.json"
+
+# Multiplier of the (row, item) hash used by the positive bitmap, shared with model.TripletNet
+POSITIVE_BITMAP_PRIME = 1000003
+
+def positive_bitmap(rows: np.ndarray, items: np.ndarray, n_bits: int) -> np.ndarray:
+    '''
+    Pack the (row, item) positives of a batch into a hashed bitmap of n_bits.
+    Collisions only mark extra pairs as positive, so masking stays conservative.
+    '''
+    bits = np.zeros(n_bits, dtype=bool)
+    bits[(rows.astype(np.int64) * POSITIVE_BITMAP_PRIME + items.astype(np.int64)) % n_bits] = True
+    return np.packbits(bits, bitorder="little")
+
+def write_triplet_store(path: str, columns: Dict[str, np.ndarray]) -> None:
+    '''
+    Write flat columns as .npy files under path. The directory is renamed into
+    place only when complete, so concurrent readers never see a partial store.
+    '''
+    if os.path.exists(os.path.join(path, TRIPLET_STORE_META)):
+        return
+
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+
+    for name, values in columns.items():
+        np.save(os.path.join(tmp_path, name + ".npy"), values)
+
+    with open(os.path.join(tmp_path, TRIPLET_STORE_META), "w") as f:
+        json.dump({name: [str(values.dtype), list(values.shape)] for name, values in columns.items()}, f)
+
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process finished the same store first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+def open_triplet_store(path: str) -> Dict[str, np.ndarray]:
+    '''
+    Open every column of the store as a read-only memmap, so all DataLoader
+    workers share the same physical pages.
+    '''
+    with open(os.path.join(path, TRIPLET_STORE_META)) as f:
+        meta = json.load(f)
+
+    # Empty files cannot be mapped
+    return {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r" if np.prod(shape) > 0 else None)
+            for name, (dtype, shape) in meta.items()}
+
 class MFWithBPRDataset(Dataset):
     def __init__(
         self,
@@ -114,19 +168,79 @@ class TripletWithNegativeListDataset(InteractionsDataset):
         data_frame = data_frame[data_frame[project_config.output_column.name] > 0]
         super().__init__(data_frame, embeddings_for_metadata, project_config, index_mapping)
         #
-        self.all_items = list(index_mapping[project_config.item_column.name].values())
+        self.all_items = np.array(list(index_mapping[project_config.item_column.name].values()), dtype=np.int64)
         self.len_all_items = len(self.all_items)
+        self._item_stride  = int(self.all_items.max()) + 1
         self._negative_proportion = 1
+        self._negative_list_size  = 2000
+        self._max_sampling_rounds = 10
         #np.array(list(range(self._data_frame[self._input_columns[0]].max())) )
 
-        self.positive_interactions = embeddings_for_metadata.set_index('ItemID')
-        self.positive_interactions['sub_a_b_all'] =  self.positive_interactions.sub_a_b_all.apply(lambda x: [] if str(x) == 'nan' else x)
+        # Flat training store, memory-mapped and shared between workers. Keyed by
+        # the training task (store_key) or, without one, by a hash of its content
+        data_key, store_key = kwargs.get('data_key', 'data'), kwargs.get('store_key')
+
+        columns = None if store_key else self._store_columns(embeddings_for_metadata)
+        self._store_path = os.path.join(self._project_config.base_dir, "triplet_store",
+                                        "{}_{}".format(data_key, store_key or self._content_key(columns)))
+
+        if columns is None and not os.path.exists(os.path.join(self._store_path, TRIPLET_STORE_META)):
+            columns = self._store_columns(embeddings_for_metadata)
+        if columns is not None:
+            os.makedirs(os.path.dirname(self._store_path), exist_ok=True)
+            write_triplet_store(self._store_path, columns)
+
+        self._store = open_triplet_store(self._store_path)
+        self._item_stride = len(self._positive_indptr) - 1
         
         self.__getitem__([1, 2])
 
     def __len__(self) -> int:
         return self._data_frame.shape[0]
 
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        del state['_store']
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._store = open_triplet_store(self._store_path)
+
+    @property
+    def _positive_indptr(self) -> np.ndarray:
+        return self._store['positive_indptr']
+
+    @property
+    def _positive_indices(self) -> np.ndarray:
+        return self._store['positive_indices']
+
+    def _store_columns(self, metadata: pd.DataFrame) -> Dict[str, np.ndarray]:
+        '''
+        Flatten the item columns (int32), the output columns (float32) and the
+        CSR positives into the store columns.
+        '''
+        positive_indptr, positive_indices = self._build_positive_index(metadata)
+
+        item_columns   = [self._input_columns[1].name, self._input_columns[2].name]
+        output_columns = [self._project_config.output_column.name] + \
+                         [column.name for column in self._project_config.auxiliar_output_columns]
+
+        columns = {name: self._data_frame[name].values.astype(np.int32) for name in item_columns}
+        columns.update({name: self._data_frame[name].values.astype(np.float32) for name in output_columns})
+        columns['positive_indptr']  = positive_indptr
+        columns['positive_indices'] = positive_indices
+
+        return columns
+
+    def _content_key(self, columns: Dict[str, np.ndarray]) -> str:
+        digest = hashlib.md5()
+        for name, values in columns.items():
+            digest.update(name.encode())
+            digest.update(np.ascontiguousarray(values).tobytes())
+
+        return digest.hexdigest()
+
     def create_co_occurences_matrix(self, allowed_words, documents):
         word_to_id = dict(zip(allowed_words, range(len(allowed_words))))
         documents_as_ids = [np.sort([word_to_id[w] for w in doc if w in word_to_id]).astype('uint32') for doc in documents]
@@ -140,42 +254,128 @@ class TripletWithNegativeListDataset(InteractionsDataset):
         return words_cooc_matrix, word_to_id 
         
 
-    def _get_negatives(self, all_positive):
-        sub_negative = self.setdiff(self.all_items, all_positive)
-        np.random.shuffle(sub_negative)
-        return sub_negative[:2000]
+    def _build_positive_index(self, metadata: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Compile the sub_a_b_all metadata into a CSR (indptr, indices) structure
+        keyed by item index, so row lookups are plain array slicing.
+        '''
+        positives = metadata[['ItemID', 'sub_a_b_all']].copy()
+        positives['sub_a_b_all'] = positives.sub_a_b_all.apply(lambda x: [] if str(x) == 'nan' else x)
+        positives = positives.sort_values('ItemID')
+
+        item_idx = positives.ItemID.values.astype(np.int64)
+        lengths  = positives.sub_a_b_all.apply(len).values.astype(np.int64)
+        self._item_stride = max(self._item_stride, int(item_idx.max()) + 1 if len(item_idx) else 0)
+
+        indptr   = np.zeros(self._item_stride + 1, dtype=np.int64)
+        np.add.at(indptr, item_idx + 1, lengths)
+        indptr   = np.cumsum(indptr)
+        indices  = np.fromiter(chain.from_iterable(positives.sub_a_b_all.values),
+                                dtype=np.int32, count=int(lengths.sum()))
+
+        return indptr, indices
+
+    def _gather_positives(self, items: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Returns (row, item) pairs of every positive of each item in the batch.
+        '''
+        items   = np.asarray(items, dtype=np.int64)
+        starts  = self._positive_indptr[items]
+        lengths = self._positive_indptr[items + 1] - starts
+
+        rows    = np.repeat(np.arange(len(items), dtype=np.int64), lengths)
+        offsets = np.arange(lengths.sum(), dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+        return rows, self._positive_indices[np.repeat(starts, lengths) + offsets].astype(np.int64)
+
+    def _get_positive_keys(self, item_arch: np.ndarray, item_positive: np.ndarray) -> np.ndarray:
+        '''
+        Union of the anchor and positive item positives for each row, encoded
+        as sorted unique (row * item_stride + item) keys.
+        '''
+        arch_rows, arch_items = self._gather_positives(item_arch)
+        pos_rows, pos_items   = self._gather_positives(item_positive)
+
+        return np.unique(np.concatenate([arch_rows * self._item_stride + arch_items,
+                                         pos_rows * self._item_stride + pos_items]))
+
+    def _get_negatives(self, keys: np.ndarray, n_rows: int) -> np.ndarray:
+        '''
+        Draw a (B, negative_list_size) matrix of negatives by rejection sampling,
+        excluding every positive of its row. Positives come as the sorted
+        (row, item) keys so membership is a single searchsorted for the batch.
+        '''
+        def is_positive(rows: np.ndarray, items: np.ndarray) -> np.ndarray:
+            query = rows * self._item_stride + items
+            idx   = np.minimum(np.searchsorted(keys, query), max(len(keys) - 1, 0))
+            return (keys[idx] == query) if len(keys) else np.zeros(query.shape, dtype=bool)
+
+        rows      = np.repeat(np.arange(n_rows, dtype=np.int64), self._negative_list_size)\
+                        .reshape(n_rows, self._negative_list_size)
+        negatives = self.all_items[np.random.randint(self.len_all_items, size=rows.shape)]
+        rejected  = is_positive(rows, negatives)
+
+        for _ in range(self._max_sampling_rounds):
+            if not rejected.any():
+                return negatives
+            negatives[rejected] = self.all_items[np.random.randint(self.len_all_items, size=rejected.sum())]
+            rejected[rejected]  = is_positive(rows[rejected], negatives[rejected])
+
+        # Rows whose positives cover most of the catalog, fallback to the exact difference
+        for row in np.unique(np.nonzero(rejected)[0]):
+            row_keys   = keys[(keys // self._item_stride) == row]
+            candidates = self.setdiff(self.all_items, row_keys % self._item_stride)
+            if len(candidates) > 0:
+                negatives[row, rejected[row]] = np.random.choice(candidates, rejected[row].sum())
+
+        return negatives
+
+    def _get_negative_input(self, keys: np.ndarray, n_rows: int) -> np.ndarray:
+        return self._get_negatives(keys, n_rows)
 
     def setdiff(self, ticks, new_ticks):
-        #return np.setdiff1d(ticks, new_ticks)
-        return list(set(ticks) - set(new_ticks))
+        return np.setdiff1d(ticks, new_ticks)
 
     def __getitem__(self, indices: Union[int, List[int]]) -> Tuple[Tuple[np.ndarray, np.ndarray, np.ndarray],
                                                                    list]:
         if isinstance(indices, int):
             indices = [indices]
 
-        rows: pd.Series = self._data_frame.iloc[indices]
+        indices = np.asarray(indices)
         
-        item_arch      = rows[self._input_columns[1].name].values
-        item_positive  = rows[self._input_columns[2].name].values
+        item_arch      = self._store[self._input_columns[1].name][indices].astype(np.int64)
+        item_positive  = self._store[self._input_columns[2].name][indices].astype(np.int64)
         #all_positives  = rows[self._input_columns[3].name].values
-        arch_all_positives  = self.positive_interactions.loc[item_arch].sub_a_b_all.values
-        pos_all_positives   = self.positive_interactions.loc[item_positive].sub_a_b_all.values
-        
-        all_positives       = [np.unique(a + p)  for a, p in zip(arch_all_positives, pos_all_positives)]
-        all_pos             = rows[self._project_config.auxiliar_output_columns[0].name].values
-        output              = rows[self._project_config.output_column.name].values
+        positive_keys       = self._get_positive_keys(item_arch, item_positive)
+        all_pos             = self._store[self._project_config.auxiliar_output_columns[0].name][indices]
+        output              = self._store[self._project_config.output_column.name][indices]
         
         if self._project_config.auxiliar_output_columns:
-            output = tuple(rows[auxiliar_output_column.name].values
+            output = tuple(self._store[auxiliar_output_column.name][indices]
                                             for auxiliar_output_column in self._project_config.auxiliar_output_columns)
         
         if self._negative_proportion > 0:
             
-            item_negative = [self._get_negatives(all_positive) for all_positive in all_positives]
-            min_item      = np.min([len(l) for l in item_negative])
-            item_negative = np.array([l[:min_item] for l in item_negative])
+            item_negative = self._get_negative_input(positive_keys, len(indices))
 
             return (item_arch, item_positive, item_negative, all_pos),output#), output
         else:
             return (item_arch, item_positive, all_pos), output
+
+class TripletWithPositiveBitmapDataset(TripletWithNegativeListDataset):
+    '''
+    Ships only anchor/positive ids plus a hashed bitmap of the batch positives.
+    Hard negatives are mined inside TripletNet over its item embedding index.
+    '''
+    # Bits per batch positive, a candidate is a false positive with ~1/bits_per_positive chance
+    positive_bitmap_bits_per_positive: int = 64
+    min_positive_bitmap_bits: int = 2 ** 10
+
+    def positive_bitmap_bits(self, n_positives: int) -> int:
+        # Power of two (and so whole bytes), sized to the positives of the batch
+        n_bits = max(self.min_positive_bitmap_bits, n_positives * self.positive_bitmap_bits_per_positive)
+        return 1 << int(np.ceil(np.log2(n_bits)))
+
+    def _get_negative_input(self, keys: np.ndarray, n_rows: int) -> np.ndarray:
+        return positive_bitmap(keys // self._item_stride, keys % self._item_stride,
+                               self.positive_bitmap_bits(len(keys)))
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Tuple
 
 import torch
 import torch.nn as nn
@@ -6,25 +6,70 @@ import torch.nn.functional as F
 from torch.nn.modules.loss import _Loss
 
 import torchbearer
-from torchbearer import metrics, Metric
+from torchbearer import metrics, Metric, Callback
 from torchbearer.metrics import default_for_key, running_mean, mean
 import torch.nn.functional as F
 
 
 
+TRIPLET_DISTANCES = torchbearer.state_key("triplet_distances")
+
+class LossStateCallback(Callback):
+    '''
+    Points the loss' torchbearer_state at the state of the running pass on
+    every batch. Trial.run works on a copy of trial.state, so the state
+    mars_gym hands to the loss never holds the current batch.
+    '''
+    def __init__(self, loss: nn.Module):
+        super().__init__()
+        self.loss = loss
+
+    def on_sample(self, state):
+        self.loss.torchbearer_state = state
+
+    def on_sample_validation(self, state):
+        self.loss.torchbearer_state = state
+
+def triplet_distances(anchor: torch.Tensor, positive: torch.Tensor, negative: torch.Tensor,
+                      p: float = 2., eps: float = 1e-6) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    '''
+    Anchor-positive, anchor-negative and positive-negative (swap) distances.
+    '''
+    return (F.pairwise_distance(anchor, positive, p, eps),
+            F.pairwise_distance(anchor, negative, p, eps),
+            F.pairwise_distance(positive, negative, p, eps))
+
+class TripletDistanceMetric(Metric):
+    '''
+    Metric over the batch distances RelativeTripletLoss shared in the state,
+    computed here only for other criteria.
+    '''
+    def process(self, *args):
+        state = args[0]
+        anchor, positive, negative = state[torchbearer.Y_PRED][:3]
+
+        shared = state.get(TRIPLET_DISTANCES)
+        if shared is not None and shared[0] is anchor:
+            distances = shared[1]
+        else:
+            distances = triplet_distances(anchor.detach(), positive.detach(), negative.detach())
+
+        return self.metric(*distances)
+
+    def metric(self, positive_distance: torch.Tensor, negative_distance: torch.Tensor,
+               positive_negative_distance: torch.Tensor) -> torch.Tensor:
+        raise NotImplementedError
+
+
 @metrics.default_for_key("triplet_acc")
 @running_mean
 @mean
-@metrics.lambda_metric("triplet_acc", on_epoch=False)
-def triplet_acc(y_pred: torch.Tensor, y_true: torch.Tensor):
-    p=2.
-    eps=1e-6
-    
-    anchor, positive, negative  = y_pred
-    positive_distance = F.pairwise_distance(anchor, positive, p, eps)
-    negative_distance = F.pairwise_distance(anchor, negative, p, eps)
+class TripletAcc(TripletDistanceMetric):
+    def __init__(self):
+        super().__init__("triplet_acc")
 
-    return (positive_distance < negative_distance).view(-1).float()
+    def metric(self, positive_distance, negative_distance, positive_negative_distance):
+        return (positive_distance < negative_distance).view(-1).float()
 
 
 @metrics.default_for_key("triplet_mse")
@@ -42,22 +87,18 @@ def triplet_mse(y_pred: torch.Tensor, y_true: torch.Tensor):
 @metrics.default_for_key("triplet_dist")
 @running_mean
 @mean
-@metrics.lambda_metric("triplet_dist", on_epoch=False)
-def triplet_dist(y_pred: torch.Tensor, y_true: torch.Tensor):
-    p=2.
-    eps=1e-6
-    margin=1
-    swap=True
-    c = 100
-
-    anchor, positive, negative = y_pred
-    relative_pos, total_ocr = y_true
+class TripletDist(TripletDistanceMetric):
+    '''
+    nn.TripletMarginLoss(margin=1, swap=True) per sample.
+    '''
+    margin = 1
 
-    triplet_loss = nn.TripletMarginLoss(reduction="none", margin=margin, swap=swap)
-    triplet_loss = triplet_loss(anchor, positive, negative)
-    #triplet_loss = (c/total_ocr.float())*triplet_loss
+    def __init__(self):
+        super().__init__("triplet_dist")
 
-    return triplet_loss
+    def metric(self, positive_distance, negative_distance, positive_negative_distance):
+        #triplet_loss = (c/total_ocr.float())*triplet_loss
+        return torch.relu(positive_distance - torch.min(negative_distance, positive_negative_distance) + self.margin)
 
 class ContrastiveLoss(_Loss):
     """
@@ -162,11 +203,12 @@ class BayesianPersonalizedRankingTripletLoss(_Loss):
         self.margin = margin
 
     def forward(self, anchor, positive, negative, pos):
-        positive_distance = F.pairwise_distance(anchor, positive, self.p, self.eps)/(torch.log2(pos.float()+1))
-        negative_distance = F.pairwise_distance(anchor, negative, self.p, self.eps)
+        return self.distance_loss(*triplet_distances(anchor, positive, negative, self.p, self.eps), pos)
+
+    def distance_loss(self, positive_distance, negative_distance, positive_negative_distance, pos):
+        positive_distance = positive_distance/(torch.log2(pos.float()+1))
 
         if self.swap:
-            positive_negative_distance = F.pairwise_distance(positive, negative, self.p, self.eps)
             negative_distance = torch.min(negative_distance, positive_negative_distance)
 
         loss = -F.logsigmoid(negative_distance - positive_distance)
@@ -187,11 +229,13 @@ class TripletMarginLoss(_Loss):
         self.eps = eps
         
     def forward(self, anchor: torch.Tensor, positive: torch.Tensor, negative: torch.Tensor, pos) -> torch.Tensor:
-        positive_distance = F.pairwise_distance(anchor, positive, self.p, self.eps)/(torch.log2(pos.float()+1))
-        negative_distance = F.pairwise_distance(anchor, negative, self.p, self.eps)
+        return self.distance_loss(*triplet_distances(anchor, positive, negative, self.p, self.eps), pos)
+
+    def distance_loss(self, positive_distance: torch.Tensor, negative_distance: torch.Tensor,
+                      positive_negative_distance: torch.Tensor, pos) -> torch.Tensor:
+        positive_distance = positive_distance/(torch.log2(pos.float()+1))
 
         if self.swap:
-            positive_negative_distance = F.pairwise_distance(positive, negative, self.p, self.eps)
             negative_distance = torch.min(negative_distance, positive_negative_distance)
 
         loss = torch.relu(positive_distance - negative_distance + self.margin)
@@ -220,6 +264,7 @@ class RelativeTripletLoss(_Loss):
         self.c  = c
         self.mse = nn.MSELoss(reduction="none")
         self.l2_reg = l2_reg
+        self.torchbearer_state = None # running state, set by LossStateCallback
 
         if triplet_loss == "triplet_margin":
             self.triplet_loss = TripletMarginLoss(p=self.p, reduction="none", margin=self.margin, swap=self.swap)
@@ -229,7 +274,12 @@ class RelativeTripletLoss(_Loss):
             raise NotImplementedError
 
     def forward(self, anchor, positive, negative, relative_pos, total_ocr):
-        loss = self.triplet_loss(anchor, positive, negative, relative_pos)
+        # Distances computed once per batch, shared with triplet_acc/triplet_dist
+        distances = triplet_distances(anchor, positive, negative, self.triplet_loss.p, self.triplet_loss.eps)
+        if self.torchbearer_state is not None:
+            self.torchbearer_state[TRIPLET_DISTANCES] = (anchor, tuple(d.detach() for d in distances))
+
+        loss = self.triplet_loss.distance_loss(*distances, relative_pos)
         
         # Discount Popularity Bias
         popularity_bias = (self.c/total_ocr.float()) if self.c > 0 else 1
@@ -242,4 +292,68 @@ class RelativeTripletLoss(_Loss):
         if self.reduction == "mean":
             return loss.mean()
         else:
-            return loss.sum()
\ No newline at end of file
+            return loss.sum()
+
+class InBatchSoftmaxLoss(_Loss):
+    '''
+    N-pair / InfoNCE: softmax of each anchor over every positive of the batch
+    (the other rows are its negatives) and, optionally, its mined negative.
+    Keeps the RelativeTripletLoss relative position and popularity weights.
+    Other rows with the anchor's own positive item are not its negatives.
+    '''
+    def __init__(self, c=100, temperature=1., l2_reg=1e-6, use_negative=True, size_average=None,
+                 reduce=None, reduction="mean"):
+        super().__init__(size_average, reduce, reduction)
+        self.c = c
+        self.temperature = temperature
+        self.l2_reg = l2_reg
+        self.use_negative = use_negative
+        self.torchbearer_state = None # running state, set by LossStateCallback
+
+    def duplicate_positives(self, positive: torch.Tensor) -> torch.Tensor:
+        '''
+        (B, B) mask of the off-diagonal columns holding the row's own positive
+        item, by the positive ids of the batch input or, outside a trial, by
+        equal positive embeddings.
+        '''
+        if self.torchbearer_state is not None and torchbearer.X in self.torchbearer_state:
+            positive_ids = self.torchbearer_state[torchbearer.X][1].to(positive.device)
+            same = positive_ids.unsqueeze(1) == positive_ids.unsqueeze(0)
+        else:
+            same = (positive.unsqueeze(1) == positive.unsqueeze(0)).all(dim=2)
+
+        return same & ~torch.eye(positive.size(0), dtype=torch.bool, device=positive.device)
+
+    def forward(self, anchor, positive, negative, relative_pos, total_ocr):
+        logits = anchor.matmul(positive.t()) # (B, B)
+        logits = logits.masked_fill(self.duplicate_positives(positive), float("-inf"))
+        if self.use_negative:
+            logits = torch.cat([logits, (anchor * negative).sum(1, keepdim=True)], dim=1) # (B, B+1)
+
+        target = torch.arange(anchor.size(0), device=anchor.device)
+        loss = F.cross_entropy(logits / self.temperature, target, reduction="none")
+
+        # Relative position, as the triplet losses discount the positive distance
+        loss = loss/(torch.log2(relative_pos.float()+1))
+
+        # Discount Popularity Bias
+        popularity_bias = (self.c/total_ocr.float()) if self.c > 0 else 1
+        loss = loss*popularity_bias
+
+        # Regularize L2 Weigth emb
+        regularization = self.l2_reg * (anchor.norm(dim=0).pow(2).sum() + positive.norm(dim=0).pow(2).sum() + negative.norm(dim=0).pow(2).sum())/3
+        loss =  loss + regularization
+
+        if self.reduction == "mean":
+            return loss.mean()
+        else:
+            return loss.sum()
+
+class SampledCrossEntropyLoss(nn.CrossEntropyLoss):
+    '''
+    Cross-entropy of a sampled softmax forward, (B, C) candidate logits and
+    the targets' positions among the candidates (the labels are ignored), or
+    of full (B, I) logits and labels, as the models return in evaluation.
+    '''
+    def forward(self, logits, targets, *labels):
+        return super().forward(logits, targets.long())
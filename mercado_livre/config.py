@@ -64,6 +64,21 @@ mercado_livre_triplet =  ProjectConfig(
     auxiliar_output_columns=[Column("relative_pos", IOType.NUMBER), 
                             Column("total_ocr", IOType.NUMBER)],
     recommender_type=RecommenderType.USER_BASED_COLLABORATIVE_FILTERING,
+)
+
+mercado_livre_triplet_mining =  ProjectConfig(
+    base_dir=data.BASE_DIR,
+    prepare_data_frames_task=data.IntraSessionInteractionsDataFrame,
+    dataset_class=dataset.TripletWithPositiveBitmapDataset,
+    user_column=Column("SessionIDX", IOType.INDEXABLE),
+    item_column=Column("ItemID", IOType.INDEXABLE),
+    timestamp_column_name="Timestamp",
+    other_input_columns=[Column("ItemID_B", IOType.INDEXABLE, same_index_as="ItemID")],
+    metadata_columns=[Column("sub_a_b_all", IOType.INDEXABLE_ARRAY, same_index_as="ItemID")],
+    output_column=Column("visit", IOType.NUMBER),
+    auxiliar_output_columns=[Column("relative_pos", IOType.NUMBER), 
+                            Column("total_ocr", IOType.NUMBER)],
+    recommender_type=RecommenderType.USER_BASED_COLLABORATIVE_FILTERING,
 )  
 
 mercado_livre_rnn = ProjectConfig(
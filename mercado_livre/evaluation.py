@@ -10,17 +10,20 @@ from mars_gym.utils.index_mapping import (
 )
 from mars_gym.evaluation.task import BaseEvaluationTask
 from mercado_livre.data import PreProcessSessionTestDataset, SessionPrepareTestDataset
+from pipeline import read_session_parquet, iter_session_parquet
+from util.compositional import embedding_memory_report
+from concurrent.futures import ThreadPoolExecutor
 import abc
-from typing import Type, Dict, List, Optional, Tuple, Union, Any, cast
+from typing import Type, Dict, List, Optional, Tuple, Union, Any, Iterator, cast
 from torch.utils.data import DataLoader
 from mars_gym.torch.data import NoAutoCollationDataLoader, FasterBatchSampler
 from torchbearer import Trial
 
-import gc
 import luigi
 import pandas as pd
 import numpy as np
 import os
+import json
 import pickle
 import torch
 import torch.nn as nn
@@ -55,6 +58,8 @@ class MLEvaluationTask(BaseEvaluationTask):
     pin_memory: bool = luigi.BoolParameter(default=False)
     batch_size: int = luigi.IntParameter(default=100)
     device: str = luigi.ChoiceParameter(choices=["cpu", "cuda"], default="cuda")
+    top_k: int = luigi.IntParameter(default=10)
+    chunk_size: int = luigi.IntParameter(default=0, significant=False)
 
     @property
     def task_name(self):
@@ -101,13 +106,9 @@ class MLEvaluationTask(BaseEvaluationTask):
             pin_memory=self.pin_memory if self.device == "cuda" else False,
         )
 
-    def run(self):
-        os.makedirs(self.output().path)
-        df: pd.DataFrame = pd.read_csv(self.input().path)
-
+    def prepare_test_data_frame(self, df: pd.DataFrame) -> pd.DataFrame:
         # Index test dataset 
         df['Index'] = df['SessionID']
-        print(df.head())
 
         df = preprocess_interactions_data_frame(
             df, 
@@ -118,47 +119,72 @@ class MLEvaluationTask(BaseEvaluationTask):
             self.model_training.index_mapping, 
             self.model_training.project_config
         )
-        df = df.sort_values("Index")
-
-        print(df.head())
-        print(df.shape)
-        
-        generator = self.get_test_generator(df)
+        return df.sort_values("Index")
+
+    def _next_test_data_frame(self, chunks: Iterator[pd.DataFrame]) -> Optional[pd.DataFrame]:
+        df = next(chunks, None)
+
+        return None if df is None else self.prepare_test_data_frame(df)
+
+    def iter_test_data_frames(self) -> Iterator[pd.DataFrame]:
+        '''
+        Prepared test sessions, whole or in chunks of chunk_size rows. The
+        next chunk is read and indexed in a background thread meanwhile.
+        '''
+        if self.chunk_size <= 0:
+            yield self.prepare_test_data_frame(read_session_parquet(self.input().path))
+            return
+
+        # The prepared test set is written ordered by SessionID
+        chunks = iter_session_parquet(self.input().path, self.chunk_size)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(self._next_test_data_frame, chunks)
+            while True:
+                df = future.result()
+                if df is None:
+                    break
+                future = executor.submit(self._next_test_data_frame, chunks)
+                yield df
 
+    def run(self):
+        os.makedirs(self.output().path)
 
         # Gente Model
         model = self.model_training.get_trained_module()
         model.to(self.torch_device)
         model.eval()
 
-        scores = []
-        rank_list = []
-        #with Pool(os.cpu_count()) as p:
-        #    list(tqdm(p.starmap(_get_rank_list, )))
+        # Memory saved by the compositional item tables, to set against the
+        # metrics of the same model with the full embedding backend
+        extra_params = self.model_training.recommender_extra_params
+        with open(os.path.join(self.output().path, "embedding_memory.json"), "w") as f:
+            json.dump(dict(embedding_backend=extra_params.get("embedding_backend", "full"),
+                           embedding_memory=extra_params.get("embedding_memory", 1.0),
+                           **embedding_memory_report(model)), f, cls=JsonEncoder, indent=4)
 
         reverse_index_mapping = self.model_training.reverse_index_mapping['ItemID']
         reverse_index_mapping[1] = 0
 
+        # Item index -> submission item id
+        item_ids = np.zeros(max(reverse_index_mapping.keys()) + 1, dtype=np.int64)
+        item_ids[list(reverse_index_mapping.keys())] = [int(item) for item in reverse_index_mapping.values()]
+
         # Inference
-        with torch.no_grad():
-            for i, (x, _) in tqdm(enumerate(generator), total=len(generator)):
-                
-                input_params = x if isinstance(x, list) or isinstance(x, tuple) else [x]
-                input_params = [t.to(self.torch_device) for t in input_params]
+        with torch.no_grad(), open(self.output().path+'/submission_{}.csv'.format(self.task_name), "w") as f:
+            for df in self.iter_test_data_frames():
+                print(df.shape)
+                generator = self.get_test_generator(df)
 
-                scores_tensor: torch.Tensor  = model(*input_params)
-                scores_batch = scores_tensor.detach().cpu().numpy()
-                #scores.extend(scores_batch)
+                for i, (x, _) in tqdm(enumerate(generator), total=len(generator)):
 
+                    input_params = x if isinstance(x, list) or isinstance(x, tuple) else [x]
+                    input_params = [t.to(self.torch_device, non_blocking=True) for t in input_params]
 
-                for score in tqdm(scores_batch, total=len(scores_batch)):
-                    item_idx  = np.argsort(score)[::-1][:10]
-                    #from IPython import embed; embed()
-                    item_id   = [int(reverse_index_mapping[item]) for item in item_idx]
-                    rank_list.append(item_id)
+                    scores_tensor: torch.Tensor  = model(*input_params)
+                    item_idx = torch.topk(scores_tensor, self.top_k, dim=1).indices.cpu().numpy()
 
-                gc.collect()
-        np.savetxt(self.output().path+'/submission_{}.csv'.format(self.task_name), np.array(rank_list).astype(int), fmt='%i', delimiter=',') 
+                    np.savetxt(f, item_ids[item_idx], fmt='%i', delimiter=',')
 
                 # scores_tensor: torch.Tensor  = model.recommendation_score(*input_params)
                 # scores_batch: List[float] = scores_tensor.cpu().numpy().reshape(-1).tolist()
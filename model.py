@@ -1,4 +1,4 @@
-from typing import Dict, Any, List, Tuple, Union
+from typing import Callable, Dict, Any, List, Tuple, Union
 import os
 import luigi
 import pandas as pd
@@ -12,6 +12,8 @@ from mars_gym.model.abstract import RecommenderModule
 from mars_gym.model.bandit import BanditPolicy
 from mars_gym.torch.init import lecun_normal_init
 import pickle
+import contextlib
+import functools
 
 from numpy.random.mtrand import RandomState
 import random
@@ -22,36 +24,54 @@ import torch
 import torch.nn as nn
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from util.transformer import *
+from util.embedding import load_embedding_weights, load_index_mapping
+from util.compositional import EmbeddingLinear, build_embedding, init_embedding_, embedding_chunks, embedding_rows
+from dataset import POSITIVE_BITMAP_PRIME
 import copy
 
 
 #---------------------------------- AUX --------------------
 
-def load_embedding(_n_items, n_factors, path_item_embedding, path_from_index_mapping, index_mapping, freeze_embedding):
+def load_embedding(_n_items, n_factors, path_item_embedding, path_from_index_mapping, index_mapping, freeze_embedding,
+                   backend="full", memory=1.0):
 
-    if path_from_index_mapping and path_item_embedding:
-        embs = nn.Embedding(_n_items, n_factors)
+    if backend != "full" and memory < 1:
+        # Compositional tables are trained from scratch
+        if path_item_embedding:
+            raise ValueError("path_item_embedding needs the full embedding backend")
+        embs = build_embedding(_n_items, n_factors, backend, memory)
 
-        # Load extern index mapping
-        if os.path.exists(path_from_index_mapping):
-            with open(path_from_index_mapping, "rb") as f:
-                from_index_mapping = pickle.load(f)    
+    elif path_from_index_mapping and path_item_embedding:
+        embs = nn.Embedding(_n_items, n_factors)
 
         # Load weights embs
-        extern_weights = np.loadtxt(path_item_embedding)#*100
+        extern_weights, id_mapping = load_embedding_weights(path_item_embedding)#*100
+
+        # Load extern index mapping, or the one stored with the embeddings
+        from_index_mapping = load_index_mapping(path_from_index_mapping, id_mapping)
+
         intern_weights = embs.weight.detach().numpy()
 
-        # new_x =  g(f-1(x))
-        reverse_index_mapping = {value_: key_ for key_, value_ in index_mapping['ItemID'].items()}
-        
-        embs_weights = np.array([extern_weights[from_index_mapping['ItemID'][reverse_index_mapping[i]]] if from_index_mapping['ItemID'][reverse_index_mapping[i]] > 1 else intern_weights[i] for i in np.arange(_n_items) ])
-        #from_index_mapping['ItemID'][reverse_index_mapping[i]]
-        #from IPython import embed; embed()
+        # new_x =  g(f-1(x)), -1 where the item is missing from the extern mapping
+        target = pd.Series(index_mapping['ItemID'])
+        source = pd.Series(from_index_mapping['ItemID']).reindex(target.index).fillna(-1).values.astype(np.int64)
+        inside = target.values < _n_items
+
+        remap  = np.full(_n_items, -1, dtype=np.int64)
+        remap[target.values[inside]] = source[inside]
+
+        # Extern rows 0 and 1 are reserved (pad/unknown), keep the intern init there
+        found        = remap > 1
+        if not found.any():
+            raise ValueError("No item of the index mapping found in the mapping of {}".format(path_item_embedding))
+
+        embs_weights = intern_weights.copy()
+        embs_weights[found] = extern_weights[remap[found]]
         embs = nn.Embedding.from_pretrained(torch.from_numpy(embs_weights).float(), freeze=freeze_embedding)
         
     elif path_item_embedding:
         # Load extern embs
-        extern_weights = torch.from_numpy(np.loadtxt(path_item_embedding)).float()
+        extern_weights = torch.from_numpy(np.array(load_embedding_weights(path_item_embedding)[0])).float()
     
         embs = nn.Embedding.from_pretrained(extern_weights, freeze=freeze_embedding)
     else:
@@ -59,6 +79,221 @@ def load_embedding(_n_items, n_factors, path_item_embedding, path_from_index_map
 
     return embs
 
+# mars_gym's index mapping keeps 0 for unknown and 1 for None values
+FIRST_ITEM_INDEX = 2
+
+PRECISIONS = ["float32", "autocast", "bfloat16"]
+
+def precision_context(precision: str, device: torch.device):
+    '''
+    bfloat16 autocast (CPU or CUDA) unless precision is float32.
+    '''
+    if precision != "float32" and hasattr(torch, "autocast"):
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    return contextlib.ExitStack()
+
+def set_precision(module: nn.Module, precision: str) -> None:
+    '''
+    "autocast" computes in bfloat16 over float32 weights, "bfloat16" also
+    stores the weights (the embedding tables) in bfloat16.
+    '''
+    if precision not in PRECISIONS:
+        raise ValueError("precision must be one of {}".format(PRECISIONS))
+
+    module.precision = precision
+    if precision == "bfloat16":
+        module.to(torch.bfloat16)
+
+def with_precision(method: Callable) -> Callable:
+    '''
+    Runs a forward under the module's precision and returns float32 outputs.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        device = next(self.parameters()).device
+        with precision_context(getattr(self, "precision", "float32"), device):
+            output = method(self, *args, **kwargs)
+
+        if isinstance(output, tuple):
+            return tuple(o.float() if torch.is_floating_point(o) else o for o in output)
+        return output.float() if torch.is_floating_point(output) else output
+
+    return wrapper
+
+def output_rows(out: nn.Module, item_ids: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    '''
+    Weight and bias rows of an output layer (nn.Linear or EmbeddingLinear)
+    for the given items, without the full weight of a compositional table.
+    '''
+    if isinstance(out, EmbeddingLinear):
+        return out.embedding(item_ids), out.bias[item_ids]
+    return out.weight[item_ids], out.bias[item_ids]
+
+def sampled_logits(features: torch.Tensor, item_ids: torch.Tensor, n_items: int, n_sampled_negatives: int,
+                   rows: Callable) -> Tuple[torch.Tensor, torch.Tensor]:
+    '''
+    Sampled softmax over the batch targets and n_sampled_negatives uniform
+    negatives: (B, C) logits of the C unique candidates, whose output
+    (weight, bias or None) rows come from rows(candidates), and the position
+    of each target among them, for loss.SampledCrossEntropyLoss.
+    '''
+    candidates = item_ids.long()
+    if n_sampled_negatives > 0:
+        negatives  = torch.randint(1, n_items, (n_sampled_negatives,), device=item_ids.device)
+        candidates = torch.cat([candidates, negatives])
+    candidates, positions = torch.unique(candidates, return_inverse=True)
+
+    weight, bias = rows(candidates)
+    logits = torch.matmul(features, weight.permute(1, 0))
+    if bias is not None:
+        logits = logits + bias
+
+    return logits, positions[:item_ids.size(0)]
+
+def causal_attention_mask(size: int) -> torch.Tensor:
+    # Additive float mask, as SASRec has always passed it to MultiheadAttention
+    return (~torch.tril(torch.ones((size, size), dtype=torch.float)).bool()).float()
+
+def self_attention(layer: nn.MultiheadAttention, query: torch.Tensor, seqs: torch.Tensor,
+                   attn_mask: torch.Tensor, key_padding_mask: torch.Tensor = None) -> torch.Tensor:
+    '''
+    Batch-first (B, T, E) attention with the weights of `layer`, through
+    scaled_dot_product_attention when available.
+    '''
+    if not hasattr(F, "scaled_dot_product_attention"):
+        mha_outputs, _ = layer(query.transpose(0, 1), seqs.transpose(0, 1), seqs.transpose(0, 1),
+                                attn_mask=attn_mask, key_padding_mask=key_padding_mask)
+        return mha_outputs.transpose(0, 1)
+
+    B, T, E  = query.shape
+    heads    = layer.num_heads
+    w_q, w_k, w_v = layer.in_proj_weight.chunk(3)
+    b_q, b_k, b_v = layer.in_proj_bias.chunk(3)
+
+    q = F.linear(query, w_q, b_q).view(B, T, heads, E // heads).transpose(1, 2)
+    k = F.linear(seqs, w_k, b_k).view(B, T, heads, E // heads).transpose(1, 2)
+    v = F.linear(seqs, w_v, b_v).view(B, T, heads, E // heads).transpose(1, 2)
+
+    mask = attn_mask.to(q.dtype)
+    if key_padding_mask is not None:
+        mask = mask.masked_fill(key_padding_mask[:, None, None, :], float("-inf"))
+
+    out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask,
+                                         dropout_p=layer.dropout if layer.training else 0.0)
+
+    return layer.out_proj(out.transpose(1, 2).reshape(B, T, E))
+
+class ItemEmbeddingIndex(object):
+    '''
+    Coarse IVF partition of the item embeddings (a few spherical k-means steps).
+    Items in the same cell as a query are its approximate nearest neighbours,
+    and search() ranks the items of the n_probe closest cells (IVF-flat).
+    '''
+    def __init__(self, n_clusters: int = None, n_iter: int = 3, chunk_size: int = 65536):
+        self.n_clusters = n_clusters
+        self.n_iter     = n_iter
+        self.chunk_size = chunk_size
+
+    def _assign(self, weights: Union[torch.Tensor, nn.Module], centroids: torch.Tensor,
+                sums: torch.Tensor = None) -> torch.Tensor:
+        '''
+        Closest centroid of every item, chunk by chunk, adding the normalized
+        items to sums (the next centroids) if given.
+        '''
+        assign = []
+        for _, chunk in embedding_chunks(weights, self.chunk_size):
+            chunk = F.normalize(chunk.detach().float(), p=2, dim=1)
+            assign.append(torch.argmax(chunk.matmul(centroids.t()), dim=1))
+            if sums is not None:
+                sums.index_add_(0, assign[-1], chunk)
+
+        return torch.cat(assign)
+
+    @torch.no_grad()
+    def build(self, weights: Union[torch.Tensor, nn.Module]) -> "ItemEmbeddingIndex":
+        '''
+        weights is the (I, E) item table or an embedding module of any backend,
+        read chunk_size rows at a time.
+        '''
+        if isinstance(weights, torch.Tensor):
+            n_items, device = weights.size(0), weights.device
+        else:
+            n_items, device = weights.num_embeddings, next(weights.parameters()).device
+        n_clusters = min(self.n_clusters or int(math.sqrt(n_items)) + 1, n_items)
+
+        seeds     = torch.randperm(n_items, device=device)[:n_clusters]
+        centroids = F.normalize(embedding_rows(weights, seeds).detach().float(), p=2, dim=1)
+        for _ in range(self.n_iter):
+            sums      = torch.zeros_like(centroids)
+            self._assign(weights, centroids, sums)
+            centroids = F.normalize(sums, p=2, dim=1)
+        assign = self._assign(weights, centroids)
+
+        self.centroids      = centroids
+        self.item_cluster   = assign
+        self.sorted_items   = torch.argsort(assign)
+        self.cluster_size   = torch.bincount(assign, minlength=n_clusters)
+        self.cluster_offset = torch.cumsum(self.cluster_size, 0) - self.cluster_size
+
+        return self
+
+    def sample_neighbours(self, item_ids: torch.Tensor, n_samples: int) -> torch.Tensor:
+        '''
+        Returns (B, n_samples) items drawn from the cell of each item_id.
+        '''
+        cluster = self.item_cluster[item_ids]
+        size    = self.cluster_size[cluster].unsqueeze(1)
+        offset  = self.cluster_offset[cluster].unsqueeze(1)
+        pos     = offset + (torch.rand(item_ids.size(0), n_samples, device=item_ids.device) * size).long()
+
+        return self.sorted_items[pos]
+
+    def probed_items(self, probe: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        '''
+        Items of the (B, n_probe) probed cells, sliced out of sorted_items:
+        the flat item ids and the query row of each.
+        '''
+        size  = self.cluster_size[probe].flatten()
+        start = self.cluster_offset[probe].flatten()
+
+        # Position of each item within its slice, shifted to the slice start
+        flat_start = torch.cumsum(size, 0) - size
+        pos        = torch.arange(int(size.sum()), device=probe.device) \
+                        + torch.repeat_interleave(start - flat_start, size)
+        rows       = torch.repeat_interleave(torch.arange(probe.size(0), device=probe.device),
+                                             size.view(probe.shape).sum(1))
+
+        return self.sorted_items[pos], rows
+
+    @torch.no_grad()
+    def search(self, weights: Union[torch.Tensor, nn.Module], queries: torch.Tensor, k: int,
+               n_probe: int = 1) -> Tuple[torch.Tensor, torch.Tensor]:
+        '''
+        Top-k items by inner product with `weights` among the n_probe cells
+        closest to each query. Returns (B, k) scores and item ids (-1 if fewer
+        than k items were probed).
+        '''
+        n_queries   = queries.size(0)
+        probe       = torch.topk(F.normalize(queries.float(), p=2, dim=1).matmul(self.centroids.t()),
+                                 min(n_probe, self.centroids.size(0)), dim=1).indices
+        items, rows = self.probed_items(probe)
+        scores      = (embedding_rows(weights, items).float() * queries.float()[rows]).sum(1)
+
+        # Best first within each query: sorted by score, then (stable) by query
+        order  = torch.argsort(scores, descending=True)
+        order  = order[torch.argsort(rows[order], stable=True)]
+        rows   = rows[order]
+        counts = torch.bincount(rows, minlength=n_queries)
+        rank   = torch.arange(rows.size(0), device=rows.device) - (torch.cumsum(counts, 0) - counts)[rows]
+        keep   = rank < k
+
+        top_scores = torch.full((n_queries, k), float("-inf"), device=scores.device)
+        top_items  = torch.full((n_queries, k), -1, dtype=torch.long, device=items.device)
+        top_scores[rows[keep], rank[keep]] = scores[order][keep]
+        top_items[rows[keep], rank[keep]]  = items[order][keep]
+
+        return top_scores, top_items
+
 class LinearWeightedAvg(nn.Module):
     def __init__(self, n_inputs):
         super(LinearWeightedAvg, self).__init__()
@@ -371,6 +606,9 @@ class Caser(RecommenderModule):
         p_nv: int,
         dropout: float,
         hist_size: int,
+        precision: str = "float32",
+        embedding_backend: str = "full",
+        embedding_memory: float = 1.0,
     ):
         super().__init__(project_config, index_mapping)
         self.path_item_embedding = path_item_embedding
@@ -391,7 +629,8 @@ class Caser(RecommenderModule):
         # user and item embeddings
         #self.user_embeddings = nn.Embedding(num_users, dims)
         self.item_embeddings = load_embedding(self._n_items, n_factors, path_item_embedding, 
-                                                from_index_mapping, index_mapping, freeze_embedding)
+                                                from_index_mapping, index_mapping, freeze_embedding,
+                                                embedding_backend, embedding_memory)
 
 
         # vertical conv layer
@@ -408,7 +647,8 @@ class Caser(RecommenderModule):
         # W1, b1 can be encoded with nn.Linear
         self.fc1 = nn.Linear(fc1_dim_in, dims)
         # W2, b2 are encoded with nn.Embedding, as we don't need to compute scores for all items
-        self.W2 = nn.Embedding(num_items, dims) #+dims
+        # b2 is kept full, 1/dims of W2
+        self.W2 = build_embedding(num_items, dims, embedding_backend, embedding_memory) #+dims
         self.b2 = nn.Embedding(num_items, 1)
 
         # dropout
@@ -416,13 +656,15 @@ class Caser(RecommenderModule):
 
         # weight initialization
         #self.user_embeddings.weight.data.normal_(0, 1.0 / self.user_embeddings.embedding_dim)
-        self.item_embeddings.weight.data.normal_(0, 1.0 / self.item_embeddings.embedding_dim)
-        self.W2.weight.data.normal_(0, 1.0 / self.W2.embedding_dim)
+        init_embedding_(self.item_embeddings, nn.init.normal_, 0, 1.0 / self.item_embeddings.embedding_dim)
+        init_embedding_(self.W2, nn.init.normal_, 0, 1.0 / self.W2.embedding_dim)
         self.b2.weight.data.zero_()
 
         self.cache_x = None
+        set_precision(self, precision)
 
 
+    @with_precision
     def forward(self, session_ids, item_ids, item_history_ids): # for training        
         """
         The forward propagation used to get recommendation scores, given
@@ -507,6 +749,8 @@ class SASRec(RecommenderModule):
         num_heads: int,
         dropout: float,
         hist_size: int,
+        mask_padding: bool = False,
+        precision: str = "float32",
     ):
         super().__init__(project_config, index_mapping)
         self.path_item_embedding = path_item_embedding
@@ -520,6 +764,11 @@ class SASRec(RecommenderModule):
 
         self.pos_emb = torch.nn.Embedding(hist_size, n_factors) # TO IMPROVE
         self.emb_dropout = torch.nn.Dropout(p=dropout)
+        self.mask_padding = mask_padding
+
+        # Sliced per batch, never rebuilt on the host
+        self.register_buffer("positions", torch.arange(hist_size), persistent=False)
+        self.register_buffer("attention_mask", causal_attention_mask(hist_size), persistent=False)
 
         self.attention_layernorms = torch.nn.ModuleList() # to be Q for self-attention
         self.attention_layers = torch.nn.ModuleList()
@@ -543,31 +792,31 @@ class SASRec(RecommenderModule):
             new_fwd_layer = PointWiseFeedForward(n_factors, dropout)
             self.forward_layers.append(new_fwd_layer)
 
+        set_precision(self, precision)
+
 
     def log2feats(self, log_seqs):
         seqs = self.item_emb(log_seqs)
         seqs *= self.item_emb.embedding_dim ** 0.5
 
-        positions = np.tile(np.array(range(self.hist_size)), [log_seqs.shape[0], 1])
-        
-        seqs += self.pos_emb(torch.LongTensor(positions).to(log_seqs.device))
+        tl = seqs.shape[1] # time dim len for enforce causality
+
+        seqs += self.pos_emb(self.positions[:tl]).unsqueeze(0)
         seqs = self.emb_dropout(seqs)
 
         timeline_mask = (log_seqs == 0)#.float()
         seqs *= (~timeline_mask).float().unsqueeze(-1) # broadcast in last dim
 
-        tl = seqs.shape[1] # time dim len for enforce causality
-        attention_mask = (~torch.tril(torch.ones((tl, tl), dtype=torch.float)).bool()).float().to(log_seqs.device)
+        attention_mask = self.attention_mask[:tl, :tl]
+
+        # Padding keys are ignored, except in sessions with no item at all
+        key_padding_mask = timeline_mask & ~timeline_mask.all(dim=1, keepdim=True) if self.mask_padding else None
 
         for i in range(len(self.attention_layers)):
-            seqs = torch.transpose(seqs, 0, 1)
             Q = self.attention_layernorms[i](seqs)
-            mha_outputs, _ = self.attention_layers[i](Q, seqs, seqs, 
-                                            attn_mask=attention_mask)
-                                            # key_padding_mask=timeline_mask
-                                            # need_weights=False) this arg do not work?
+            mha_outputs = self_attention(self.attention_layers[i], Q, seqs,
+                                            attention_mask, key_padding_mask)
             seqs = Q + mha_outputs
-            seqs = torch.transpose(seqs, 0, 1)
 
             seqs = self.forward_layernorms[i](seqs)
             seqs = self.forward_layers[i](seqs)
@@ -577,6 +826,7 @@ class SASRec(RecommenderModule):
 
         return log_feats
 
+    @with_precision
     def forward(self, session_ids, item_ids, item_history_ids): # for training        
         log_feats = self.log2feats(item_history_ids) # (B, H, E)
         item_embs = self.item_emb(item_ids) # (B, E)
@@ -610,7 +860,10 @@ class GRURecModel(RecommenderModule):
         path_item_embedding: str,
         from_index_mapping: str,
         dropout: float,
-        freeze_embedding: bool
+        freeze_embedding: bool,
+        tied_weights: bool = False,
+        sampled_softmax: bool = False,
+        n_sampled_negatives: int = 0
     ):
         super().__init__(project_config, index_mapping)
         self.path_item_embedding = path_item_embedding
@@ -622,17 +875,30 @@ class GRURecModel(RecommenderModule):
         self.item_embeddings = load_embedding(self._n_items, n_factors, path_item_embedding, 
                                                 from_index_mapping, index_mapping, freeze_embedding)
 
-        self.gru = nn.GRU(n_factors, self.hidden_size, self.n_layers, dropout=self.dropout)
-        self.out = nn.Linear(self.hidden_size, self._n_items)
+        self.gru = nn.GRU(n_factors, self.hidden_size, self.n_layers, dropout=self.dropout, batch_first=True)
+
+        # Output weights tied to the item embeddings, projected when hidden_size != n_factors
+        if tied_weights:
+            self.out_projection = nn.Linear(self.hidden_size, n_factors, bias=False) \
+                                    if self.hidden_size != n_factors else None
+            self.out = EmbeddingLinear(self.item_embeddings, init_weights=False)
+        else:
+            self.out_projection = None
+            self.out = nn.Linear(self.hidden_size, self._n_items)
         self.sf  = nn.Softmax()
 
+        # Training over in-batch targets (+ uniform negatives) instead of the catalog
+        self.sampled_softmax     = sampled_softmax
+        self.n_sampled_negatives = n_sampled_negatives
+
         self.weight_init = lecun_normal_init
         self.apply(self.init_weights)
 
     def init_weights(self, module: nn.Module):
         if type(module) == nn.Linear:
             self.weight_init(module.weight)
-            module.bias.data.fill_(0.1)
+            if module.bias is not None:
+                module.bias.data.fill_(0.1)
             
     def flatten(self, input):
         return input.view(input.size(0), -1)
@@ -642,20 +908,40 @@ class GRURecModel(RecommenderModule):
             x = F.normalize(x, p=2, dim=dim)
         return x
 
-    def forward(self, session_ids, item_ids, item_history_ids):
+    def session_representation(self, item_history_ids):
         embs = self.emb_dropout(self.item_embeddings(item_history_ids))
         
         output, hidden = self.gru(embs)
         #output = output.view(-1, output.size(2))  #(B,H)
-        
+
+        output = output[:,-1]
+        if self.out_projection is not None:
+            output = self.out_projection(output)
+
+        return output
+
+    def forward(self, session_ids, item_ids, item_history_ids):
+        output = self.session_representation(item_history_ids)
+
+        # (B, C) candidate logits and targets, for the sampled_ce loss
+        if self.training and self.sampled_softmax:
+            return sampled_logits(output, item_ids, self._n_items, self.n_sampled_negatives,
+                                  functools.partial(output_rows, self.out))
+
         #out    = torch.softmax(self.out(output[:,-1]), dim=1)
-        out    = self.out(output[:,-1])
+        out    = self.session_scores(output)
         return out
 
+    def session_scores(self, output: torch.Tensor) -> torch.Tensor:
+        # (B, I) scores of a session_representation
+        return self.out(output)
+
     def recommendation_score(self, session_ids, item_ids, item_history_ids):
-        
-        scores = self.forward(session_ids, item_ids, item_history_ids)
-        scores = scores[torch.arange(scores.size(0)),item_ids]
+        # Only the target item logit
+        output       = self.session_representation(item_history_ids)
+        weight, bias = output_rows(self.out, item_ids)
+
+        scores = (output * weight).sum(1) + bias
 
         return scores
 
@@ -673,7 +959,10 @@ class NARMModel(RecommenderModule):
         path_item_embedding: str,
         from_index_mapping: str,
         freeze_embedding: bool,        
-        dropout: float        
+        dropout: float,
+        sampled_softmax: bool = False,
+        n_sampled_negatives: int = 0,
+        precision: str = "float32"
     ):
         super().__init__(project_config, index_mapping)
 
@@ -694,9 +983,35 @@ class NARMModel(RecommenderModule):
         self.b = nn.Linear(self.embedding_dim, 2 * self.hidden_size, bias=False)
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-    def forward(self, session_ids, item_ids, item_history_ids):
-        device = item_ids.device
-        seq    = item_history_ids.permute(1,0)  #TODO
+        # Training over in-batch targets (+ uniform negatives) instead of the catalog
+        self.sampled_softmax     = sampled_softmax
+        self.n_sampled_negatives = n_sampled_negatives
+        self._item_projection    = None
+
+        set_precision(self, precision)
+
+    def train(self, mode: bool = True):
+        # Weights may change, drop the cached catalog projection
+        self._item_projection = None
+        return super().train(mode)
+
+    def item_projection(self, device) -> torch.Tensor:
+        '''
+        b(emb) for the whole catalog (I, 2H), cached while in eval mode.
+        '''
+        if self.training:
+            return self.b(self.emb(torch.arange(self._n_items, device=device)))
+
+        if self._item_projection is None or self._item_projection.device != device:
+            with torch.no_grad():
+                self._item_projection = self.b(self.emb(torch.arange(self._n_items, device=device)))
+
+        return self._item_projection
+
+    @with_precision
+    def session_representation(self, item_history_ids):
+        device = item_history_ids.device
+        seq    = item_history_ids.permute(1,0)
 
         hidden = self.init_hidden(seq.size(1)).to(device)
         embs = self.emb_dropout(self.emb(seq))
@@ -722,16 +1037,43 @@ class NARMModel(RecommenderModule):
 
         c_t = torch.cat([c_local, c_global], 1)
         c_t = self.ct_dropout(c_t)
-        
-        item_embs = self.emb(torch.arange(self._n_items).to(device).long())
-        scores = torch.matmul(c_t, self.b(item_embs).permute(1, 0))
 
-        return scores
+        return c_t
+
+    @with_precision
+    def forward(self, session_ids, item_ids, item_history_ids):
+        c_t = self.session_representation(item_history_ids)
+
+        # (B, C) candidate logits and targets, for the sampled_ce loss
+        if self.training and self.sampled_softmax:
+            return sampled_logits(c_t, item_ids, self._n_items, self.n_sampled_negatives,
+                                  lambda candidates: (self.b(self.emb(candidates)), None))
+
+        return self.session_scores(c_t)
+
+    @with_precision
+    def session_scores(self, c_t: torch.Tensor) -> torch.Tensor:
+        # (B, I) scores of a session_representation
+        return torch.matmul(c_t, self.item_projection(c_t.device).permute(1, 0))
+
+    @with_precision
+    def candidate_scores(self, session_ids, item_ids, item_history_ids, candidate_ids):
+        '''
+        Scores of a candidate set only: (C,) shared or (B, C) per session.
+        '''
+        c_t        = self.session_representation(item_history_ids)
+        candidates = self.b(self.emb(candidate_ids))
+
+        if candidates.dim() == 2:
+            return torch.matmul(c_t, candidates.permute(1, 0))
+
+        return torch.bmm(candidates, c_t.unsqueeze(2)).squeeze(2)
 
+    @with_precision
     def recommendation_score(self, session_ids, item_ids, item_history_ids):
         
-        scores = self.forward(session_ids, item_ids, item_history_ids)
-        scores = scores[torch.arange(scores.size(0)),item_ids]
+        scores = self.candidate_scores(session_ids, item_ids, item_history_ids, item_ids.unsqueeze(1))
+        scores = scores[:, 0]
 
         return scores
 
@@ -837,21 +1179,31 @@ class TripletNet(RecommenderModule):
         n_factors: int, 
         use_normalize: bool,
         dropout: float,
-        negative_random: float
+        negative_random: float,
+        n_negative_candidates: int = 2000,
+        index_refresh_steps: int = 1000,
+        precision: str = "float32",
+        embedding_backend: str = "full",
+        embedding_memory: float = 1.0
     ):
 
         super().__init__(project_config, index_mapping)
 
         self.use_normalize   = use_normalize
-        self.item_embeddings = nn.Embedding(self._n_items, n_factors)
+        self.item_embeddings = build_embedding(self._n_items, n_factors, embedding_backend, embedding_memory)
         self.pos_embeddings = nn.Embedding(30, n_factors)
 
         self.negative_random = negative_random
+        self.n_negative_candidates = n_negative_candidates
+        self.index_refresh_steps   = index_refresh_steps
+        self._item_index = None
+        self._index_step = 0
         self.dropout = dropout
         #self.dropout_emb = EmbeddingDropout(dropout)
         self.dropout_emb = nn.Dropout(p=dropout)
         #self.weight_init = lecun_normal_init
         self.init_weights()
+        set_precision(self, precision)
         #self.apply(self.init_weights)
         
     def embedded_dropout(self, embed, words, dropout=0.1):
@@ -861,7 +1213,7 @@ class TripletNet(RecommenderModule):
                 
     def init_weights(self):
         initrange = 0.1
-        self.item_embeddings.weight.data.uniform_(-initrange, initrange)
+        init_embedding_(self.item_embeddings, nn.init.uniform_, -initrange, initrange)
 
     def normalize(self, x: torch.Tensor, dim: int = 1) -> torch.Tensor:
         if self.use_normalize:
@@ -899,9 +1251,73 @@ class TripletNet(RecommenderModule):
         ]
         return negative_idx
 
+    def item_index(self) -> ItemEmbeddingIndex:
+        if self._item_index is None or (self.training and self._index_step % self.index_refresh_steps == 0):
+            self._item_index = ItemEmbeddingIndex().build(self.item_embeddings)
+        if self.training:
+            self._index_step += 1
+        return self._item_index
+
+    def is_positive(self, candidates: torch.Tensor, positive_bitmap: torch.Tensor) -> torch.Tensor:
+        '''
+        Lookup (row, candidate) pairs in the hashed positive bitmap of dataset.TripletWithPositiveBitmapDataset.
+        '''
+        rows = torch.arange(candidates.size(0), device=candidates.device).unsqueeze(1)
+        bits = (rows * POSITIVE_BITMAP_PRIME + candidates) % (positive_bitmap.size(0) * 8)
+        return ((positive_bitmap.long()[bits // 8] >> (bits % 8)) & 1).bool()
+
+    def mine_harder_negative(self, item_ids: torch.Tensor,
+                            positive_item_ids: torch.Tensor,
+                            positive_bitmap: torch.Tensor,
+                            random_negative: bool = False) -> torch.Tensor:
+        '''
+        Score candidates from the anchor's index cell, masking the batch positives.
+        '''
+        item_ids, positive_item_ids = item_ids.long(), positive_item_ids.long()
+        batch_size = item_ids.size(0)
+
+        def is_invalid(candidates: torch.Tensor) -> torch.Tensor:
+            # Unknown/None ids, batch positives, the anchor or its positive
+            return (candidates < FIRST_ITEM_INDEX) | self.is_positive(candidates, positive_bitmap) \
+                    | (candidates == item_ids.unsqueeze(1)) | (candidates == positive_item_ids.unsqueeze(1))
+
+        random_candidates = torch.randint(FIRST_ITEM_INDEX, self._n_items, (batch_size, self.n_negative_candidates),
+                                          device=item_ids.device)
+        candidates = random_candidates if random_negative else \
+                        self.item_index().sample_neighbours(item_ids, self.n_negative_candidates)  # (B, S)
+
+        candidates = torch.where(is_invalid(candidates), random_candidates, candidates)
+        invalid    = is_invalid(candidates)
+
+        with torch.no_grad():
+            anchors    = self.normalize(self.item_embeddings(item_ids))  # (B, E)
+            similarity = (anchors.unsqueeze(1) * self.normalize(self.item_embeddings(candidates), dim=2)).sum(2)  # (B, S)
+            similarity = similarity.masked_fill(invalid, -float("inf"))
+            if random_negative:
+                similarity = (~invalid).float()
+
+        rows = torch.arange(0, batch_size, device=item_ids.device)
+        hardest_negative_items = torch.argmax(similarity, dim=1)  # (B,)
+        negatives = candidates[rows, hardest_negative_items]
+
+        # Rows without any valid candidate would take a positive (or the anchor), redraw them
+        exhausted = invalid.all(dim=1)
+        if exhausted.any():
+            redraw  = torch.randint(FIRST_ITEM_INDEX, self._n_items, (batch_size, max(self.n_negative_candidates, 100)),
+                                    device=item_ids.device)
+            valid   = ~is_invalid(redraw)
+            negatives = torch.where(exhausted, redraw[rows, valid.float().argmax(dim=1)], negatives)
+
+        return negatives
+
     def select_negative_item_emb(self, item_ids: torch.Tensor, positive_item_ids: torch.Tensor,
                         negative_list_idx: List[torch.Tensor] = None):
 
+        # Positive bitmap instead of negative lists, mine inside the model
+        if negative_list_idx.dtype == torch.uint8:
+            return self.mine_harder_negative(item_ids, positive_item_ids, negative_list_idx,
+                                            random_negative=random.random() < self.negative_random)
+
         if random.random() < self.negative_random:
             negative_item_idx = negative_list_idx[:,0]
         else:
@@ -912,6 +1328,7 @@ class TripletNet(RecommenderModule):
     def similarity(self, itemA, itemB):
         return torch.cosine_similarity(itemA, itemB)
 
+    @with_precision
     def forward(self, item_ids: torch.Tensor, 
                       positive_item_ids: torch.Tensor,
                       negative_list_idx: List[torch.Tensor] = None,
@@ -957,6 +1374,13 @@ class MLSASRec(RecommenderModule):
         num_heads: int,
         dropout: float,
         hist_size: int,
+        mask_padding: bool = False,
+        precision: str = "float32",
+        embedding_backend: str = "full",
+        embedding_memory: float = 1.0,
+        tied_weights: bool = False,
+        sampled_softmax: bool = False,
+        n_sampled_negatives: int = 0,
     ):
         super().__init__(project_config, index_mapping)
         self.path_item_embedding = path_item_embedding
@@ -966,10 +1390,16 @@ class MLSASRec(RecommenderModule):
         # TODO: loss += args.l2_emb for regularizing embedding vectors during training
         # https://stackoverflow.com/questions/42704283/adding-l1-l2-regularization-in-pytorch
         self.item_emb = load_embedding(self._n_items, n_factors, path_item_embedding, 
-                                                from_index_mapping, index_mapping, freeze_embedding)
+                                                from_index_mapping, index_mapping, freeze_embedding,
+                                                embedding_backend, embedding_memory)
 
         self.pos_emb = torch.nn.Embedding(hist_size, n_factors) # TO IMPROVE
         self.emb_dropout = torch.nn.Dropout(p=dropout)
+        self.mask_padding = mask_padding
+
+        # Sliced per batch, never rebuilt on the host
+        self.register_buffer("positions", torch.arange(hist_size), persistent=False)
+        self.register_buffer("attention_mask", causal_attention_mask(hist_size), persistent=False)
 
         self.attention_layernorms = torch.nn.ModuleList() # to be Q for self-attention
         self.attention_layers = torch.nn.ModuleList()
@@ -978,7 +1408,12 @@ class MLSASRec(RecommenderModule):
 
         self.last_layernorm = torch.nn.LayerNorm(n_factors, eps=1e-8)
         
-        self.out = nn.Linear(self.n_factors, self._n_items)
+        if tied_weights:
+            self.out = EmbeddingLinear(self.item_emb, init_weights=False)
+        elif embedding_backend == "full" or embedding_memory >= 1:
+            self.out = nn.Linear(self.n_factors, self._n_items)
+        else:
+            self.out = EmbeddingLinear(build_embedding(self._n_items, self.n_factors, embedding_backend, embedding_memory))
 
         for _ in range(num_blocks):
             new_attn_layernorm = torch.nn.LayerNorm(n_factors, eps=1e-8)
@@ -995,31 +1430,35 @@ class MLSASRec(RecommenderModule):
             new_fwd_layer = PointWiseFeedForward(n_factors, dropout)
             self.forward_layers.append(new_fwd_layer)
 
+        # Training over in-batch targets (+ uniform negatives) instead of the catalog
+        self.sampled_softmax     = sampled_softmax
+        self.n_sampled_negatives = n_sampled_negatives
+
+        set_precision(self, precision)
+
 
     def log2feats(self, log_seqs):
         seqs = self.item_emb(log_seqs)
         seqs *= self.item_emb.embedding_dim ** 0.5
 
-        positions = np.tile(np.array(range(self.hist_size)), [log_seqs.shape[0], 1])
-        
-        seqs += self.pos_emb(torch.LongTensor(positions).to(log_seqs.device))
+        tl = seqs.shape[1] # time dim len for enforce causality
+
+        seqs += self.pos_emb(self.positions[:tl]).unsqueeze(0)
         seqs = self.emb_dropout(seqs)
 
         timeline_mask = (log_seqs == 0)#.float()
         seqs *= (~timeline_mask).float().unsqueeze(-1) # broadcast in last dim
 
-        tl = seqs.shape[1] # time dim len for enforce causality
-        attention_mask = (~torch.tril(torch.ones((tl, tl), dtype=torch.float)).bool()).float().to(log_seqs.device)
+        attention_mask = self.attention_mask[:tl, :tl]
+
+        # Padding keys are ignored, except in sessions with no item at all
+        key_padding_mask = timeline_mask & ~timeline_mask.all(dim=1, keepdim=True) if self.mask_padding else None
 
         for i in range(len(self.attention_layers)):
-            seqs = torch.transpose(seqs, 0, 1)
             Q = self.attention_layernorms[i](seqs)
-            mha_outputs, _ = self.attention_layers[i](Q, seqs, seqs, 
-                                            attn_mask=attention_mask)
-                                            # key_padding_mask=timeline_mask
-                                            # need_weights=False) this arg do not work?
+            mha_outputs = self_attention(self.attention_layers[i], Q, seqs,
+                                            attention_mask, key_padding_mask)
             seqs = Q + mha_outputs
-            seqs = torch.transpose(seqs, 0, 1)
 
             seqs = self.forward_layernorms[i](seqs)
             seqs = self.forward_layers[i](seqs)
@@ -1031,13 +1470,23 @@ class MLSASRec(RecommenderModule):
 
         return log_feats
 
-    def forward(self, session_ids, item_ids, item_history_ids): # for training        
+    def session_representation(self, item_history_ids):
         log_feats = self.log2feats(item_history_ids) # (B, H, E)
-        item_embs = self.item_emb(item_ids) # (B, E)
         #logits    = (log_feats * item_embs).sum(-1)#.mean(1)
 
         final_feat = log_feats[:, 0, :] # (B, E)  only use last QKV classifier, a waste
 
+        return final_feat
+
+    @with_precision
+    def forward(self, session_ids, item_ids, item_history_ids): # for training        
+        final_feat = self.session_representation(item_history_ids)
+
+        # (B, C) candidate logits and targets, for the sampled_ce loss
+        if self.training and self.sampled_softmax:
+            return sampled_logits(final_feat, item_ids, self._n_items, self.n_sampled_negatives,
+                                  functools.partial(output_rows, self.out))
+
         #logits = item_embs.matmul(final_feat.unsqueeze(-1)).squeeze(-1) # (B, B)
         #logits     = (final_feat * item_embs).sum(-1) # (B)
 
@@ -1046,9 +1495,12 @@ class MLSASRec(RecommenderModule):
         
         return output
 
+    @with_precision
     def recommendation_score(self, session_ids, item_ids, item_history_ids):
-        
-        scores = self.forward(session_ids, item_ids, item_history_ids)
-        scores = scores[torch.arange(scores.size(0)),item_ids]
+        # Only the target item logit
+        final_feat   = self.session_representation(item_history_ids)
+        weight, bias = output_rows(self.out, item_ids)
+
+        scores = (final_feat * weight).sum(1) + bias
 
         return scores
\ No newline at end of file
@@ -0,0 +1,93 @@
+import argparse
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+
+from model import ItemEmbeddingIndex
+from util.embedding import load_embedding_weights
+
+'''
+Candidate generation over the full catalog from the exported item embeddings
+(TripletTraining --save-item-embedding-tsv), with an IVF-flat index.
+
+PYTHONPATH="." python retrieval.py --path-item-embedding .../item_embeddings.npy --k 10
+'''
+
+class ItemRetrieval(object):
+    '''
+    Top-k similar items (inner product) for items or session histories.
+    '''
+    def __init__(self, weights: np.ndarray, id_mapping: Optional[Dict[str, int]] = None,
+                 n_clusters: int = None, n_iter: int = 3, n_probe: int = 8):
+        self.weights    = torch.from_numpy(np.array(weights, dtype=np.float32))
+        self.id_mapping = id_mapping
+        self.n_probe    = n_probe
+        self.index      = ItemEmbeddingIndex(n_clusters=n_clusters, n_iter=n_iter).build(self.weights)
+
+    @classmethod
+    def from_artifact(cls, path_item_embedding: str, **kwargs) -> "ItemRetrieval":
+        weights, id_mapping = load_embedding_weights(path_item_embedding)
+        return cls(weights, id_mapping, **kwargs)
+
+    def session_query(self, item_history_ids: torch.Tensor) -> torch.Tensor:
+        '''
+        Mean embedding of the non-padding history items. Its inner product
+        with an item is the mean history similarity TripletPredTraining scores.
+        '''
+        mask = (item_history_ids > 0).float().unsqueeze(2)
+        embs = self.weights[item_history_ids] * mask
+
+        return embs.sum(1) / mask.sum(1).clamp(min=1)
+
+    def search(self, queries: torch.Tensor, k: int, n_probe: int = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.index.search(self.weights, queries, k, n_probe or self.n_probe)
+
+    def similar_items(self, item_ids: torch.Tensor, k: int, n_probe: int = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.search(self.weights[item_ids], k, n_probe)
+
+    def recommend(self, item_history_ids: torch.Tensor, k: int, n_probe: int = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.search(self.session_query(item_history_ids), k, n_probe)
+
+def exact_search(weights: torch.Tensor, queries: torch.Tensor, k: int,
+                 chunk_size: int = 1024) -> Tuple[torch.Tensor, torch.Tensor]:
+    scores, items = zip(*[torch.topk(chunk.matmul(weights.t()), k, dim=1)
+                            for chunk in torch.split(queries, chunk_size)])
+
+    return torch.cat(scores), torch.cat(items)
+
+def benchmark(retrieval: ItemRetrieval, queries: torch.Tensor, k: int, n_probes: List[int]) -> pd.DataFrame:
+    '''
+    Recall@k against exact search and latency per query for each n_probe.
+    '''
+    t0 = time.time()
+    _, exact_items = exact_search(retrieval.weights, queries, k)
+    exact_ms = (time.time() - t0) * 1000 / len(queries)
+
+    rows = []
+    for n_probe in n_probes:
+        t0 = time.time()
+        _, items = retrieval.search(queries, k, n_probe)
+        ms = (time.time() - t0) * 1000 / len(queries)
+
+        hits = (items.unsqueeze(2) == exact_items.unsqueeze(1)).any(dim=2).sum().item()
+        rows.append(dict(n_probe=n_probe, recall=hits / exact_items.numel(),
+                         ms_per_query=ms, exact_ms_per_query=exact_ms))
+
+    return pd.DataFrame(rows)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path-item-embedding", type=str, required=True)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--n-clusters", type=int, default=None)
+    parser.add_argument("--n-queries", type=int, default=1000)
+    parser.add_argument("--n-probes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    retrieval = ItemRetrieval.from_artifact(args.path_item_embedding, n_clusters=args.n_clusters)
+    queries   = retrieval.weights[torch.randint(0, retrieval.weights.size(0), (args.n_queries,))]
+
+    print(benchmark(retrieval, queries, args.k, args.n_probes))
@@ -0,0 +1,116 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional
+
+import torch
+import torch.nn as nn
+
+
+class SessionStateCache(object):
+    '''
+    Per-session state with LRU eviction past max_sessions and, optionally,
+    expiry ttl seconds after the session's last activity.
+    '''
+    def __init__(self, max_sessions: int = 100000, ttl: Optional[float] = None):
+        self.max_sessions = max_sessions
+        self.ttl          = ttl
+        self._states      = OrderedDict() # session -> (last activity, state), oldest first
+
+    def __len__(self) -> int:
+        self.evict()
+        return len(self._states)
+
+    def __contains__(self, session_id: Hashable) -> bool:
+        return self.get(session_id) is not None
+
+    def get(self, session_id: Hashable, default: Any = None) -> Any:
+        self.evict()
+
+        if session_id not in self._states:
+            return default
+
+        state = self._states.pop(session_id)[1]
+        self._states[session_id] = (time.time(), state)
+
+        return state
+
+    def put(self, session_id: Hashable, state: Any) -> None:
+        self._states.pop(session_id, None)
+        self._states[session_id] = (time.time(), state)
+        self.evict()
+
+    def evict(self) -> None:
+        while len(self._states) > self.max_sessions:
+            self._states.popitem(last=False)
+
+        if self.ttl is not None:
+            expired = time.time() - self.ttl
+            while self._states and next(iter(self._states.values()))[0] < expired:
+                self._states.popitem(last=False)
+
+class IncrementalSessionScorer(object):
+    '''
+    Click-by-click scoring for the session models fed with ItemIDHistory
+    (GRURecModel, NARMModel). They are trained on the session's first
+    hist_size clicks, most recent first and right-padded with 0
+    (pipeline.pad_history), so each session caches that window and its
+    session_representation. While the window fills, a click recomputes the
+    representation over hist_size items; once it is full the history no
+    longer changes and a click only scores the cached representation.
+    '''
+    def __init__(self, model: nn.Module, hist_size: int, cache: SessionStateCache = None):
+        if not (hasattr(model, "session_representation") and hasattr(model, "session_scores")):
+            raise ValueError("{} has no session_representation/session_scores".format(type(model).__name__))
+
+        self.model     = model
+        self.hist_size = hist_size
+        self.cache     = cache if cache is not None else SessionStateCache()
+
+    def history(self, sessions: List[List[int]]) -> torch.Tensor:
+        '''
+        (B, hist_size) ItemIDHistory of the clicks of each session.
+        '''
+        history = torch.zeros((len(sessions), self.hist_size), dtype=torch.long)
+        for i, items in enumerate(sessions):
+            if items:
+                history[i, :len(items)] = torch.tensor(items[::-1])
+
+        return history
+
+    def click(self, session_id: Hashable, item_id: int) -> torch.Tensor:
+        return self.step([session_id], torch.tensor([item_id]))[0]
+
+    def step(self, session_ids: List[Hashable], item_ids: torch.Tensor) -> torch.Tensor:
+        '''
+        Registers one click per session and returns the (B, I) scores of the
+        next item, with the sessions whose window changed in a single batched
+        session_representation.
+        '''
+        if len(set(session_ids)) != len(session_ids):
+            raise ValueError("one click per session and step")
+
+        states = []
+        for session_id, item_id in zip(session_ids, item_ids.tolist()):
+            state = self.cache.get(session_id) or dict(items=[], representation=None)
+            if len(state["items"]) < self.hist_size:
+                state = dict(items=state["items"] + [item_id], representation=None)
+            states.append(state)
+
+        device = next(self.model.parameters()).device
+        stale  = [i for i, state in enumerate(states) if state["representation"] is None]
+
+        # eval() would drop the model's cached catalog projection on every step
+        if self.model.training:
+            self.model.eval()
+        with torch.no_grad():
+            if stale:
+                history = self.history([states[i]["items"] for i in stale]).to(device)
+                for i, representation in zip(stale, self.model.session_representation(history)):
+                    states[i]["representation"] = representation
+
+            scores = self.model.session_scores(torch.stack([state["representation"] for state in states]))
+
+        for session_id, state in zip(session_ids, states):
+            self.cache.put(session_id, state)
+
+        return scores.float()
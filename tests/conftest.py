@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+N_ITEMS = 50
+
+
+@pytest.fixture(autouse=True)
+def seed():
+    torch.manual_seed(0)
+
+
+@pytest.fixture
+def index_mapping():
+    return {"SessionID": {0: 1}, "ItemID": {i: i for i in range(N_ITEMS)}}
@@ -0,0 +1,56 @@
+import pytest
+import torch
+
+import model
+from mercado_livre.config import mercado_livre_interaction
+
+
+def module_attention(layer, query, seqs, attn_mask, key_padding_mask=None):
+    # nn.MultiheadAttention over (T, B, E), as SASRec called it before self_attention
+    out, _ = layer(query.transpose(0, 1), seqs.transpose(0, 1), seqs.transpose(0, 1),
+                   attn_mask=attn_mask, key_padding_mask=key_padding_mask)
+    return out.transpose(0, 1)
+
+
+@pytest.mark.parametrize("padding", [False, True])
+def test_self_attention_matches_multihead_attention(padding):
+    layer = torch.nn.MultiheadAttention(8, 2).eval()
+    query, seqs = torch.randn(3, 5, 8), torch.randn(3, 5, 8)
+    mask  = model.causal_attention_mask(5)
+
+    key_padding_mask = torch.tensor([[False] * 5, [False] * 3 + [True] * 2, [False] + [True] * 4]) if padding else None
+
+    with torch.no_grad():
+        fused    = model.self_attention(layer, query, seqs, mask, key_padding_mask)
+        expected = module_attention(layer, query, seqs, mask,
+                                    None if key_padding_mask is None else key_padding_mask.float() * -1e9)
+
+    assert torch.allclose(fused, expected, atol=1e-5)
+
+
+def baseline_log2feats(module, log_seqs):
+    # MLSASRec.log2feats before the cached buffers and self_attention
+    seqs  = module.item_emb(log_seqs) * module.item_emb.embedding_dim ** 0.5
+    seqs += module.pos_emb(torch.arange(log_seqs.size(1)).repeat(log_seqs.size(0), 1))
+    seqs *= (log_seqs != 0).float().unsqueeze(-1)
+
+    attention_mask = (~torch.tril(torch.ones((log_seqs.size(1), log_seqs.size(1)))).bool()).float()
+    for i in range(len(module.attention_layers)):
+        Q    = module.attention_layernorms[i](seqs)
+        seqs = Q + module_attention(module.attention_layers[i], Q, seqs, attention_mask)
+        seqs = module.forward_layers[i](module.forward_layernorms[i](seqs))
+        seqs *= (log_seqs != 0).float().unsqueeze(-1)
+
+    return module.last_layernorm(seqs)
+
+
+def test_sasrec_matches_the_baseline_log2feats(index_mapping):
+    module = model.MLSASRec(mercado_livre_interaction, index_mapping, path_item_embedding=None,
+                            from_index_mapping=None, freeze_embedding=False, n_factors=8, num_blocks=2,
+                            num_heads=2, dropout=0.0, hist_size=5).eval()
+    history = torch.tensor([[5, 7, 9, 0, 0], [3, 0, 0, 0, 0], [8, 9, 10, 11, 12]])
+
+    with torch.no_grad():
+        assert torch.allclose(module.log2feats(history), baseline_log2feats(module, history), atol=1e-5)
+
+    assert "positions" not in module.state_dict() and "attention_mask" not in module.state_dict()
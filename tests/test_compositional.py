@@ -0,0 +1,56 @@
+import torch
+import torch.nn.functional as F
+
+from model import ItemEmbeddingIndex
+from util.compositional import EmbeddingLinear, HashEmbedding, QREmbedding, embedding_chunks
+
+
+class CountedQREmbedding(QREmbedding):
+    # Largest lookup, to check the full table is never built
+    largest = 0
+
+    def forward(self, ids):
+        CountedQREmbedding.largest = max(CountedQREmbedding.largest, ids.numel())
+        return super().forward(ids)
+
+
+def full_table(embedding):
+    return embedding(torch.arange(embedding.num_embeddings))
+
+
+def test_compositional_tables_have_no_materializing_weight():
+    assert not hasattr(QREmbedding(100, 8, 10), "weight")
+    assert not hasattr(HashEmbedding(100, 8, 10), "weight")
+    assert not hasattr(EmbeddingLinear(QREmbedding(100, 8, 10)), "weight")
+
+
+def test_embedding_chunks_cover_the_table():
+    embedding = HashEmbedding(100, 8, 10)
+    ids, rows = zip(*embedding_chunks(embedding, chunk_size=30))
+
+    assert torch.equal(torch.cat(ids), torch.arange(100))
+    assert torch.allclose(torch.cat(rows), full_table(embedding))
+
+
+def test_embedding_linear_logits_by_chunks():
+    out = EmbeddingLinear(QREmbedding(100, 8, 10))
+    out.chunk_size = 30
+    torch.nn.init.normal_(out.bias)
+    x = torch.randn(4, 8)
+
+    assert torch.allclose(out(x), F.linear(x, full_table(out.embedding), out.bias), atol=1e-6)
+
+
+def test_index_built_from_the_module_in_chunks():
+    embedding = CountedQREmbedding(1000, 8, 40)
+
+    torch.manual_seed(1)
+    expected = ItemEmbeddingIndex(n_clusters=10, chunk_size=128).build(full_table(embedding).detach())
+
+    CountedQREmbedding.largest = 0
+    torch.manual_seed(1)
+    index = ItemEmbeddingIndex(n_clusters=10, chunk_size=128).build(embedding)
+
+    assert CountedQREmbedding.largest <= 128
+    assert torch.equal(index.item_cluster, expected.item_cluster)
+    assert torch.allclose(index.centroids, expected.centroids, atol=1e-6)
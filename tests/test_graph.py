@@ -0,0 +1,31 @@
+import numpy as np
+
+from util.graph import k_hop_positives
+
+
+def bfs_positives(item_a, item_b, max_deep):
+    graph = {}
+    for a, b in zip(item_a, item_b):
+        graph.setdefault(a, set()).add(b)
+
+    positives = {}
+    for source in graph:
+        reach, frontier = set(graph[source]), set(graph[source])
+        for _ in range(max_deep):
+            frontier = set(n for item in frontier for n in graph.get(item, ())) - reach
+            reach   |= frontier
+        positives[source] = sorted(reach)
+
+    return positives
+
+
+def test_k_hop_positives_matches_bfs():
+    rng    = np.random.default_rng(0)
+    item_a = rng.integers(0, 60, 150)
+    item_b = rng.integers(0, 60, 150)
+    expected = bfs_positives(item_a, item_b, 2)
+
+    for n_jobs in (1, 2):
+        items, positives = k_hop_positives(item_a, item_b, 2, chunk_size=16, n_jobs=n_jobs)
+
+        assert dict(zip(items.tolist(), positives)) == expected
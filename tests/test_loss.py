@@ -0,0 +1,89 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torchbearer
+from torch.utils.data import DataLoader, TensorDataset
+from torchbearer import Trial
+from torchbearer.callbacks import on_criterion
+
+import loss as loss_module
+from loss import InBatchSoftmaxLoss, LossStateCallback, RelativeTripletLoss, triplet_distances
+
+ITEM_IDS     = torch.tensor([1, 2, 3, 4, 5, 6])
+POSITIVE_IDS = torch.tensor([7, 8, 7, 9, 8, 10]) # rows 0/2 and 1/4 share their positive
+
+
+class NoisyTriplets(nn.Module):
+    # Positives differ per row, as with dropout, so only their ids tell duplicates apart
+    def __init__(self, n_items=20, n_factors=8):
+        super().__init__()
+        self.emb = nn.Embedding(n_items, n_factors)
+
+    def forward(self, item_ids, positive_ids, negative_ids):
+        positive = self.emb(positive_ids) + 0.1 * torch.randn(positive_ids.size(0), self.emb.embedding_dim)
+        return self.emb(item_ids), positive, self.emb(negative_ids)
+
+
+def run_trial_step(criterion, callbacks, metrics=[]):
+    module  = NoisyTriplets()
+    batches = []
+
+    @on_criterion
+    def record(state):
+        batches.append((state[torchbearer.X], tuple(y.detach() for y in state[torchbearer.Y_PRED]),
+                        state[torchbearer.LOSS].item()))
+
+    loader = DataLoader(TensorDataset(ITEM_IDS, POSITIVE_IDS, ITEM_IDS + 10, torch.ones(6), torch.full((6,), 100.)),
+                        batch_size=6)
+    loader = [((i, p, n), (r, t)) for i, p, n, r, t in loader]
+
+    trial = Trial(module, torch.optim.SGD(module.parameters(), lr=0.1), criterion,
+                  metrics=metrics, callbacks=callbacks + [record], verbose=0)
+    criterion.torchbearer_state = trial.state # as mars_gym's create_trial does
+    history = trial.with_train_generator(loader).run(1)
+
+    return batches[0] + (history[0],)
+
+
+def test_in_batch_softmax_masks_duplicate_positives_in_trial():
+    criterion = InBatchSoftmaxLoss(c=0, l2_reg=0, use_negative=False)
+
+    x, (anchor, positive, _), loss, _ = run_trial_step(criterion, [LossStateCallback(criterion)])
+
+    duplicate = (x[1].unsqueeze(1) == x[1].unsqueeze(0)) & ~torch.eye(6, dtype=torch.bool)
+    logits    = (anchor @ positive.t()).masked_fill(duplicate, float("-inf"))
+    expected  = F.cross_entropy(logits, torch.arange(6))
+
+    assert duplicate.sum() == 4
+    assert abs(loss - expected.item()) < 1e-5
+
+
+def test_in_batch_softmax_masks_equal_positive_embeddings():
+    criterion = InBatchSoftmaxLoss(c=0, l2_reg=0, use_negative=False)
+    anchor    = torch.randn(4, 8)
+    positive  = torch.randn(3, 8)[torch.tensor([0, 1, 0, 2])]
+
+    loss     = criterion(anchor, positive, torch.randn(4, 8), torch.ones(4), torch.ones(4))
+    logits   = (anchor @ positive.t()).masked_fill(torch.tensor([[0, 0, 1, 0], [0, 0, 0, 0], [1, 0, 0, 0], [0, 0, 0, 0]]).bool(),
+                                                   float("-inf"))
+    expected = F.cross_entropy(logits, torch.arange(4))
+
+    assert torch.allclose(loss, expected)
+
+
+def test_triplet_metrics_reuse_the_loss_distances(monkeypatch):
+    calls = []
+    def counted_triplet_distances(*args, **kwargs):
+        calls.append(args[0])
+        return triplet_distances(*args, **kwargs)
+    monkeypatch.setattr(loss_module, "triplet_distances", counted_triplet_distances)
+
+    criterion = RelativeTripletLoss(c=0, l2_reg=0)
+
+    _, (anchor, positive, negative), _, metrics = run_trial_step(
+        criterion, [LossStateCallback(criterion)], metrics=["triplet_acc", "triplet_dist"])
+
+    positive_distance, negative_distance, _ = triplet_distances(anchor, positive, negative)
+
+    assert len(calls) == 1
+    assert abs(metrics["running_triplet_acc"] - (positive_distance < negative_distance).float().mean().item()) < 1e-6
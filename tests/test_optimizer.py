@@ -0,0 +1,88 @@
+import copy
+
+import pytest
+import torch
+import torch.nn as nn
+
+from util.optimizer import SparseDenseOptimizer, sparse_embedding_parameters
+
+
+class Scorer(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.emb    = nn.Embedding(30, 4)
+        self.linear = nn.Linear(4, 1)
+
+    def forward(self, ids):
+        return self.linear(self.emb(ids)).sum()
+
+
+def sparse_dense_optimizer(module, weight_decay=0.):
+    sparse = sparse_embedding_parameters(module)
+    dense  = [p for p in module.parameters() if all(p is not s for s in sparse)]
+    return SparseDenseOptimizer(torch.optim.Adagrad(dense, lr=0.1, weight_decay=weight_decay),
+                                torch.optim.Adagrad(sparse, lr=0.1), weight_decay=weight_decay)
+
+
+def run_steps(module, optimizer, batches):
+    for ids in batches:
+        optimizer.zero_grad()
+        module(ids).backward()
+        optimizer.step()
+
+
+BATCHES = [torch.tensor([1, 2, 3]), torch.tensor([3, 4, 3]), torch.tensor([2, 7])]
+
+
+def test_sparse_steps_match_dense_adagrad():
+    dense_module  = Scorer()
+    sparse_module = copy.deepcopy(dense_module)
+
+    run_steps(dense_module, torch.optim.Adagrad(dense_module.parameters(), lr=0.1), BATCHES)
+    run_steps(sparse_module, sparse_dense_optimizer(sparse_module), BATCHES)
+
+    assert sparse_module.emb.sparse
+    assert torch.allclose(sparse_module.emb.weight, dense_module.emb.weight, atol=1e-6)
+    assert torch.allclose(sparse_module.linear.weight, dense_module.linear.weight, atol=1e-6)
+
+
+def test_weight_decay_is_applied_to_the_looked_up_rows_only():
+    dense_module  = Scorer()
+    sparse_module = copy.deepcopy(dense_module)
+    initial       = dense_module.emb.weight.detach().clone()
+    # Lazy decay agrees with the dense one on rows looked up at every step
+    ids           = torch.tensor([1, 2, 3, 3])
+
+    run_steps(dense_module, torch.optim.Adagrad(dense_module.parameters(), lr=0.1, weight_decay=0.01), [ids] * 3)
+    run_steps(sparse_module, sparse_dense_optimizer(sparse_module, 0.01), [ids] * 3)
+
+    looked_up = torch.unique(ids)
+    untouched = torch.tensor([i for i in range(30) if i not in looked_up.tolist()])
+
+    assert torch.allclose(sparse_module.emb.weight[looked_up], dense_module.emb.weight[looked_up], atol=1e-6)
+    assert torch.allclose(sparse_module.linear.weight, dense_module.linear.weight, atol=1e-6)
+    assert torch.equal(sparse_module.emb.weight[untouched], initial[untouched])
+    assert not torch.equal(dense_module.emb.weight[untouched], initial[untouched])
+
+
+def test_dense_gradient_of_a_sparse_table_is_stepped_over_its_rows():
+    dense_module  = Scorer()
+    sparse_module = copy.deepcopy(dense_module)
+    optimizer     = sparse_dense_optimizer(sparse_module)
+    sparse_module.emb.sparse = False # e.g. also used as a tied output layer
+
+    run_steps(dense_module, torch.optim.Adagrad(dense_module.parameters(), lr=0.1), BATCHES)
+    run_steps(sparse_module, optimizer, BATCHES)
+
+    assert torch.allclose(sparse_module.emb.weight, dense_module.emb.weight, atol=1e-6)
+
+
+def test_state_dict_round_trip():
+    module    = Scorer()
+    optimizer = sparse_dense_optimizer(module)
+    run_steps(module, optimizer, BATCHES)
+
+    restored = sparse_dense_optimizer(copy.deepcopy(module))
+    restored.load_state_dict(optimizer.state_dict())
+
+    assert restored.state_dict()["sparse"]["state"].keys() == optimizer.state_dict()["sparse"]["state"].keys()
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from pipeline import sample_items
+
+
+def test_sample_items_draws_distinct_items():
+    items     = np.arange(5000)
+    all_items = np.arange(10000) + 2
+
+    samples = sample_items(items, all_items, 100)
+
+    drawn = np.sort(samples[:, :-1], axis=1)
+    assert samples.shape == (5000, 100)
+    assert not (drawn[:, 1:] == drawn[:, :-1]).any()
+    assert np.isin(drawn, all_items).all()
+    assert (samples[:, -1] == items).all()
+
+
+def test_sample_items_whole_catalog():
+    samples = sample_items(np.arange(3), np.arange(10), 11)
+
+    assert (np.sort(samples[:, :-1], axis=1) == np.arange(10)).all()
+
+
+def test_sample_items_larger_than_the_catalog():
+    with pytest.raises(ValueError):
+        sample_items(np.arange(3), np.arange(10), 12)
@@ -0,0 +1,73 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+import model
+from loss import SampledCrossEntropyLoss
+from mercado_livre.config import mercado_livre_interaction
+
+N_SAMPLED = 10
+
+
+def narm(index_mapping):
+    return model.NARMModel(mercado_livre_interaction, index_mapping, n_factors=8, n_layers=1, hidden_size=12,
+                           path_item_embedding=None, from_index_mapping=None, freeze_embedding=False, dropout=0.0,
+                           sampled_softmax=True, n_sampled_negatives=N_SAMPLED)
+
+
+def gru(index_mapping, tied_weights=False):
+    return model.GRURecModel(mercado_livre_interaction, index_mapping, n_factors=8, hidden_size=12, n_layers=1,
+                             path_item_embedding=None, from_index_mapping=None, dropout=0.0, freeze_embedding=False,
+                             tied_weights=tied_weights, sampled_softmax=True, n_sampled_negatives=N_SAMPLED)
+
+
+def sasrec(index_mapping, **kwargs):
+    return model.MLSASRec(mercado_livre_interaction, index_mapping, path_item_embedding=None, from_index_mapping=None,
+                          freeze_embedding=False, n_factors=8, num_blocks=1, num_heads=2, dropout=0.0, hist_size=5,
+                          sampled_softmax=True, n_sampled_negatives=N_SAMPLED, **kwargs)
+
+
+MODELS = dict(
+    narm=narm,
+    gru=gru,
+    gru_tied=lambda index_mapping: gru(index_mapping, tied_weights=True),
+    sasrec=sasrec,
+    sasrec_qr=lambda index_mapping: sasrec(index_mapping, embedding_backend="qr", embedding_memory=0.3),
+)
+
+
+def without_dropout(module):
+    for m in module.modules():
+        if isinstance(m, torch.nn.Dropout):
+            m.p = 0.0
+    return module
+
+
+@pytest.mark.parametrize("name", MODELS.keys())
+def test_sampled_logits_are_the_candidate_columns(name, index_mapping):
+    module   = without_dropout(MODELS[name](index_mapping))
+    history  = torch.randint(2, 50, (6, 5))
+    item_ids = torch.tensor([3, 9, 3, 17, 25, 40])
+
+    module.train()
+    torch.manual_seed(7)
+    logits, targets = module(None, item_ids, history)
+
+    torch.manual_seed(7)
+    candidates = torch.unique(torch.cat([item_ids, torch.randint(1, 50, (N_SAMPLED,))]))
+
+    module.eval()
+    with torch.no_grad():
+        full = module(None, item_ids, history)
+
+    assert logits.shape == (6, len(candidates))
+    assert torch.equal(candidates[targets], item_ids)
+    assert torch.allclose(logits, full[:, candidates], atol=1e-5)
+
+
+def test_sampled_cross_entropy():
+    logits  = torch.randn(4, 7)
+    targets = torch.tensor([0, 3, 3, 6])
+
+    assert torch.allclose(SampledCrossEntropyLoss()(logits, targets, torch.zeros(4)),
+                          F.cross_entropy(logits, targets))
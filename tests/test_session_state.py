@@ -0,0 +1,82 @@
+import pytest
+import torch
+
+import model
+from mercado_livre.config import mercado_livre_interaction
+from session_state import IncrementalSessionScorer, SessionStateCache
+
+HIST_SIZE = 4
+
+SESSIONS = {"a": [5, 7, 9, 11, 13, 15], "b": [3, 4], "c": [8, 9, 10, 2]}
+
+
+def item_id_history(clicks, hist_size):
+    # pipeline.pad_history: first hist_size clicks, most recent first, right-padded
+    window = clicks[:hist_size][::-1]
+    return window + [0] * (hist_size - len(window))
+
+
+def gru_model(index_mapping):
+    return model.GRURecModel(mercado_livre_interaction, index_mapping, n_factors=8, hidden_size=12, n_layers=2,
+                             path_item_embedding=None, from_index_mapping=None, dropout=0.0,
+                             freeze_embedding=False).eval()
+
+
+def narm_model(index_mapping):
+    return model.NARMModel(mercado_livre_interaction, index_mapping, n_factors=8, n_layers=1, hidden_size=12,
+                           path_item_embedding=None, from_index_mapping=None, freeze_embedding=False,
+                           dropout=0.0).eval()
+
+
+@pytest.mark.parametrize("build", [gru_model, narm_model])
+def test_step_matches_forward_on_item_id_history(build, index_mapping):
+    module = build(index_mapping)
+    scorer = IncrementalSessionScorer(module, HIST_SIZE)
+
+    for t in range(max(len(clicks) for clicks in SESSIONS.values())):
+        session_ids = [s for s, clicks in SESSIONS.items() if t < len(clicks)]
+        scores      = scorer.step(session_ids, torch.tensor([SESSIONS[s][t] for s in session_ids]))
+
+        history = torch.tensor([item_id_history(SESSIONS[s][:t + 1], HIST_SIZE) for s in session_ids])
+        with torch.no_grad():
+            expected = module(None, None, history)
+
+        assert torch.allclose(scores, expected, atol=1e-5)
+
+
+def test_full_window_reuses_representation(index_mapping):
+    scorer = IncrementalSessionScorer(gru_model(index_mapping), HIST_SIZE)
+    for item_id in SESSIONS["a"][:HIST_SIZE]:
+        scorer.click("a", item_id)
+    representation = scorer.cache.get("a")["representation"]
+
+    scorer.click("a", 42)
+
+    assert scorer.cache.get("a")["representation"] is representation
+    assert scorer.cache.get("a")["items"] == SESSIONS["a"][:HIST_SIZE]
+
+
+def test_gru_rows_are_independent(index_mapping):
+    module  = gru_model(index_mapping)
+    history = torch.tensor([[5, 7, 0, 0], [3, 0, 0, 0]])
+    with torch.no_grad():
+        scores = module(None, None, history)
+        alone  = module(None, None, history[:1])
+
+    assert torch.allclose(scores[:1], alone, atol=1e-6)
+
+
+def test_one_click_per_session_and_step(index_mapping):
+    scorer = IncrementalSessionScorer(gru_model(index_mapping), HIST_SIZE)
+    with pytest.raises(ValueError):
+        scorer.step(["a", "a"], torch.tensor([1, 2]))
+
+
+def test_cache_evicts_least_recently_used():
+    cache = SessionStateCache(max_sessions=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+
+    assert "a" in cache and "c" in cache and "b" not in cache
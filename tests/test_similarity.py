@@ -0,0 +1,22 @@
+import numpy as np
+from scipy.sparse import random as sparse_random
+
+from util.similarity import top_k_cosine_similarity
+
+
+def dense_top_k(matrix, k):
+    dense = matrix.toarray()
+    dense = dense / np.maximum(np.linalg.norm(dense, axis=1, keepdims=True), 1e-12)
+    sim   = dense @ dense.T
+    return np.sort(sim, axis=1)[:, ::-1][:, :k]
+
+
+def test_top_k_cosine_similarity_matches_dense():
+    matrix = sparse_random(300, 50, density=0.2, format="csr", random_state=0)
+
+    for n_jobs in (1, 2):
+        sim = top_k_cosine_similarity(matrix, k=5, chunk_size=64, n_jobs=n_jobs)
+        top = np.sort(sim.toarray(), axis=1)[:, ::-1][:, :5]
+
+        assert sim.shape == (300, 300)
+        assert np.allclose(top, dense_top_k(matrix, 5), atol=1e-5)
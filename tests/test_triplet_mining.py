@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+import torch
+
+import dataset
+import model
+from mercado_livre.config import mercado_livre_triplet
+
+ITEM_IDS     = torch.tensor([2, 3, 4, 5, 6, 7])
+POSITIVE_IDS = torch.tensor([10, 11, 12, 13, 14, 15])
+
+
+@pytest.fixture
+def triplet_net(index_mapping):
+    index_mapping = dict(index_mapping, SessionIDX=index_mapping["SessionID"])
+    return model.TripletNet(mercado_livre_triplet, index_mapping, n_factors=8, use_normalize=True,
+                            dropout=0.0, negative_random=0.0, n_negative_candidates=8)
+
+
+def positive_bitmap(positives):
+    rows, items = zip(*[(row, item) for row, row_items in enumerate(positives) for item in row_items])
+    return torch.from_numpy(dataset.positive_bitmap(np.array(rows), np.array(items), 1 << 14))
+
+
+@pytest.mark.parametrize("random_negative", [False, True])
+def test_mined_negatives_are_valid_items(triplet_net, random_negative):
+    bitmap = positive_bitmap([[20, 21, 22], [23]])
+
+    for _ in range(50):
+        negatives = triplet_net.mine_harder_negative(ITEM_IDS, POSITIVE_IDS, bitmap, random_negative)
+
+        assert (negatives >= model.FIRST_ITEM_INDEX).all()
+        assert (negatives != ITEM_IDS).all() and (negatives != POSITIVE_IDS).all()
+        assert not triplet_net.is_positive(negatives.unsqueeze(1), bitmap).any()
+
+
+def test_rows_with_few_valid_items_get_a_valid_negative(triplet_net):
+    # Every item below 40 is a positive of row 0, most candidates and some whole draws are invalid
+    bitmap = positive_bitmap([list(range(40))])
+
+    negatives = triplet_net.mine_harder_negative(ITEM_IDS[:1], POSITIVE_IDS[:1], bitmap)
+
+    assert 40 <= negatives.item() < triplet_net._n_items
@@ -1,7 +1,11 @@
 
-from mars_gym.simulation.training import SupervisedModelTraining, DummyTraining
-from loss import RelativeTripletLoss, ContrastiveLoss
+from mars_gym.simulation.training import TORCH_LOSS_FUNCTIONS as MARS_GYM_LOSS_FUNCTIONS
+from mars_gym.simulation.training import SupervisedModelTraining, DummyTraining, TORCH_OPTIMIZERS, \
+    TRAIN_DATA, VAL_DATA, TEST_DATA
+from loss import RelativeTripletLoss, ContrastiveLoss, InBatchSoftmaxLoss, SampledCrossEntropyLoss, LossStateCallback
 import torch
+import torchbearer
+from torchbearer import Trial
 import torch.nn as nn
 import luigi
 import numpy as np
@@ -25,6 +29,10 @@ from scipy.sparse import csr_matrix
 from pandas.api.types import CategoricalDtype
 from sklearn.metrics.pairwise import cosine_similarity
 from plot import plot_tsne
+from util.similarity import top_k_cosine_similarity
+from util.embedding import save_embedding, load_embedding_weights, load_index_mapping
+from util.optimizer import SparseDenseOptimizer, sparse_embedding_parameters
+from util.compositional import embedding_chunks
 from mars_gym.data.dataset import (
     preprocess_interactions_data_frame,
     preprocess_metadata_data_frame,
@@ -36,14 +44,43 @@ from mars_gym.utils.index_mapping import (
 )
 
 TORCH_LOSS_FUNCTIONS = dict(
+    MARS_GYM_LOSS_FUNCTIONS,
     mse=nn.MSELoss,
     nll=nn.NLLLoss,
     bce=nn.BCELoss,
     mlm=nn.MultiLabelMarginLoss,
     relative_triplet=RelativeTripletLoss,    
     contrastive_loss=ContrastiveLoss,
+    in_batch_softmax=InBatchSoftmaxLoss,
+    sampled_ce=SampledCrossEntropyLoss,
 )
 
+SPARSE_OPTIMIZERS = dict(
+    sparse_adam=torch.optim.SparseAdam,
+    adagrad=torch.optim.Adagrad,
+)
+
+def index_lookup_table(mapping: Dict[Any, int], n_index: int) -> np.ndarray:
+    '''
+    Dense id -> index array for integer ids, -1 where the id is missing
+    (or its index >= n_index).
+    '''
+    ids     = np.fromiter(mapping.keys(), dtype=np.int64, count=len(mapping))
+    indices = np.fromiter(mapping.values(), dtype=np.int64, count=len(mapping))
+
+    table = np.full(ids.max() + 1 if len(ids) else 0, -1, dtype=np.int64)
+    table[ids] = np.where(indices < n_index, indices, -1)
+
+    return table
+
+def lookup_index(table: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    ids     = np.asarray(ids, dtype=np.int64)
+    valid   = (ids >= 0) & (ids < len(table))
+
+    indices = np.full(len(ids), -1, dtype=np.int64)
+    indices[valid] = table[ids[valid]]
+
+    return indices
 
 class RandomTraining(DummyTraining):
     '''
@@ -89,7 +126,8 @@ class CoOccurrenceTraining(DummyTraining):
         cooc_matrix, to_id = self.create_co_occurences_matrix(item_idx, lists)
 
         self.columns_coocc = to_id
-        self.cooc_matrix   = cooc_matrix
+        self.cooc_matrix   = cooc_matrix.tocsr()
+        self.coocc_lookup  = index_lookup_table(to_id, min(cooc_matrix.shape))
 
 
     def create_co_occurences_matrix(self, allowed_words, documents):
@@ -108,12 +146,22 @@ class CoOccurrenceTraining(DummyTraining):
         print("get_scores...")
         #
 
-        last_items = list(ob_dataset._data_frame.ItemIDHistory.apply(lambda l: l[0]))
-        next_items = list(ob_dataset._data_frame.ItemID.values)
+        last_items = ob_dataset._data_frame.ItemIDHistory.apply(lambda l: l[0]).values
+        next_items = ob_dataset._data_frame.ItemID.values
+
+        return self.get_batch_scores(last_items, next_items)
 
-        scores = []
-        for last_item, next_item in tqdm(zip(last_items, next_items), total=len(last_items)):
-            scores.append(self.get_score(last_item, next_item))
+    def get_batch_scores(self, items_a: np.ndarray, items_b: np.ndarray) -> np.ndarray:
+        '''
+        Co-occurrence of each (item_a, item_b) in one sparse gather, 0 for unknown items.
+        '''
+        idx_a  = lookup_index(self.coocc_lookup, items_a)
+        idx_b  = lookup_index(self.coocc_lookup, items_b)
+        found  = (idx_a >= 0) & (idx_b >= 0)
+
+        scores = np.zeros(len(idx_a))
+        if found.any():
+            scores[found] = np.asarray(self.cooc_matrix[idx_a[found], idx_b[found]]).reshape(-1)
 
         return scores
 
@@ -134,18 +182,28 @@ class CoOccurrenceTraining(DummyTraining):
 
 class IKNNTraining(DummyTraining):
     '''
-    Most Popular Model
+    Item KNN Model
     '''
+    neighbours: int = luigi.IntParameter(default=0)
+    neighbours_chunk_size: int = luigi.IntParameter(default=1000, significant=False)
+    neighbours_workers: int = luigi.IntParameter(default=1, significant=False)
+
     def fit(self, df_train: pd.DataFrame):
         print("fit...")
         
         item_idx = np.unique(df_train.ItemID.values)
-        lists    = list(df_train.ItemIDHistory)
         sparse_matrix = self.create_sparse_matrix(df_train)
 
         self.matrix_item_idx  = dict(zip(item_idx, list(range(len(item_idx)))))
+        self.matrix_lookup    = index_lookup_table(self.matrix_item_idx, len(item_idx))
         self.sparse_matrix    = sparse_matrix
-        self.cos_matrix       = cosine_similarity(sparse_matrix)
+
+        # Top-k neighbours as CSR, or the dense item x item cosine matrix
+        if self.neighbours > 0:
+            self.cos_matrix   = top_k_cosine_similarity(sparse_matrix, self.neighbours,
+                                    chunk_size=self.neighbours_chunk_size, n_jobs=self.neighbours_workers)
+        else:
+            self.cos_matrix   = cosine_similarity(sparse_matrix)
 
     def create_sparse_matrix(self, df: pd.DataFrame):
                 
@@ -161,12 +219,23 @@ class IKNNTraining(DummyTraining):
     def get_scores(self, agent: BanditAgent, ob_dataset: Dataset) -> List[float]:
         print("get_scores...")
 
-        last_items = list(ob_dataset._data_frame.ItemIDHistory.apply(lambda l: l[0]))
-        next_items = list(ob_dataset._data_frame.ItemID.values)
+        last_items = ob_dataset._data_frame.ItemIDHistory.apply(lambda l: l[0]).values
+        next_items = ob_dataset._data_frame.ItemID.values
 
-        scores = []
-        for last_item, next_item in tqdm(zip(last_items, next_items), total=len(last_items)):
-            scores.append(self.get_score(last_item, next_item))
+        return self.get_batch_scores(last_items, next_items)
+
+    def get_batch_scores(self, items_a: np.ndarray, items_b: np.ndarray) -> np.ndarray:
+        '''
+        Similarity of item_b to item_a in one gather, 0 for unknown items
+        (and, with top-k neighbours, for items outside item_b's neighbours).
+        '''
+        idx_a  = lookup_index(self.matrix_lookup, items_a)
+        idx_b  = lookup_index(self.matrix_lookup, items_b)
+        found  = (idx_a >= 0) & (idx_b >= 0)
+
+        scores = np.zeros(len(idx_a))
+        if found.any():
+            scores[found] = np.asarray(self.cos_matrix[idx_b[found], idx_a[found]]).reshape(-1)
 
         return scores
 
@@ -183,14 +252,13 @@ class IKNNTraining(DummyTraining):
 class TripletPredTraining(DummyTraining):
     path_item_embedding:  str = luigi.Parameter()
     from_index_mapping:  str = luigi.Parameter()
+    score_chunk_size: int = luigi.IntParameter(default=10000, significant=False)
 
     def load_embs(self):
-        # Load extern index mapping
-        if os.path.exists(self.from_index_mapping):
-            with open(self.from_index_mapping, "rb") as f:
-                index_mapping = pickle.load(f)    
+        embs, id_mapping = load_embedding_weights(self.path_item_embedding)
 
-        embs = np.loadtxt(self.path_item_embedding)
+        # Load extern index mapping, or the one stored with the embeddings
+        index_mapping = load_index_mapping(self.from_index_mapping, id_mapping, self.project_config.item_column.name)
 
         return embs, index_mapping
 
@@ -202,40 +270,124 @@ class TripletPredTraining(DummyTraining):
         
         embs, index_mapping = self.load_embs()
         self._embs = embs
-        self._from_index_mapping = index_mapping[self.project_config.item_column.name]
-        self._rev_index_mapping = self.reverse_index_mapping[self.project_config.item_column.name]
-        
+        from_index_mapping = index_mapping[self.project_config.item_column.name]
+        rev_index_mapping  = self.reverse_index_mapping[self.project_config.item_column.name]
+
+        # Indexed item id -> row of embs (-1 if the item has no embedding)
+        self._emb_remap = np.full(max(rev_index_mapping.keys()) + 1, -1, dtype=np.int64)
+        for uid, item in rev_index_mapping.items():
+            self._emb_remap[uid] = from_index_mapping.get(item, -1)
+
+        if not (self._emb_remap[1:] >= 0).any():
+            raise ValueError("No item found in the mapping of {}".format(self.path_item_embedding))
+
     def get_scores(self, agent: BanditAgent, ob_dataset: Dataset) -> List[float]:
         print("get_scores...")
 
-        hist_items = list(ob_dataset._data_frame.ItemIDHistory)
-        next_items = list(ob_dataset._data_frame.ItemID.values)
+        hist_items = np.vstack(ob_dataset._data_frame.ItemIDHistory.values)
+        next_items = ob_dataset._data_frame.ItemID.values
 
-        scores = []
-        for hist_item, next_item in tqdm(zip(hist_items, next_items), total=len(hist_items)):
-            scores.append(self.get_score(hist_item, next_item))
+        scores = [self.get_batch_scores(hist_items[i:i + self.score_chunk_size], next_items[i:i + self.score_chunk_size])
+                    for i in tqdm(range(0, len(next_items), self.score_chunk_size))]
 
-        return pd.Series(scores).fillna(0).tolist()
+        return np.concatenate(scores).tolist() if scores else []
 
-    def get_score(self, hist_items: List[int], item_b: int):
+    def get_batch_scores(self, hist_items: np.ndarray, next_items: np.ndarray) -> np.ndarray:
+        '''
+        Mean dot similarity between each (N, H) history, up to its first
+        padding 0, and the next item. 0 when nothing is left to average.
+        '''
+        hist_idx = lookup_index(self._emb_remap, hist_items.reshape(-1)).reshape(hist_items.shape)
+        next_idx = lookup_index(self._emb_remap, next_items)
 
-        emb_hist = self.get_emb(hist_items)
-        emb_item = self.get_emb([item_b])
-        dot_sim  = emb_hist.dot(emb_item.T).reshape(-1)
+        mask     = (np.cumprod(hist_items != 0, axis=1) > 0) & (hist_idx >= 0) & (next_idx >= 0)[:, None]
 
-        if 0 in hist_items:
-            return  dot_sim[:hist_items.index(0)].mean()
-        else:
-            return  dot_sim.mean()
+        emb_hist = self._embs[np.maximum(hist_idx, 0)]                  # (N, H, E)
+        emb_item = self._embs[np.maximum(next_idx, 0)]                  # (N, E)
+        dot_sim  = np.matmul(emb_hist, emb_item[:, :, None])[:, :, 0]   # (N, H)
+
+        total    = mask.sum(axis=1)
 
-    def get_emb(self, uids: List[int]):
-        embs = [self._embs[self._from_index_mapping[self._rev_index_mapping[uid]]] for uid in uids]
-        return np.array(embs)
+        return np.where(total > 0, (dot_sim * mask).sum(axis=1) / np.maximum(total, 1), 0.0)
 
-class TripletTraining(SupervisedModelTraining):
-    loss_function:  str = luigi.ChoiceParameter(choices=["relative_triplet", "contrastive_loss"], default="relative_triplet")
+class SupervisedTraining(SupervisedModelTraining):
+    '''
+    SupervisedModelTraining with, optionally, sparse gradients for the
+    embedding tables, so a step costs the rows of the batch, not the catalog.
+    '''
+    sparse_embeddings: bool = luigi.BoolParameter(default=False)
+    sparse_optimizer: str = luigi.ChoiceParameter(choices=SPARSE_OPTIMIZERS.keys(), default="sparse_adam")
+    loss_function: str = luigi.ChoiceParameter(choices=TORCH_LOSS_FUNCTIONS.keys(), default="bce")
+
+    def _get_loss_function(self):
+        return TORCH_LOSS_FUNCTIONS[self.loss_function](**self.loss_function_params)
+
+    def create_trial(self, module: nn.Module) -> Trial:
+        trial = super().create_trial(module)
+
+        # Losses reading the batch follow the state of the running pass
+        criterion = trial.state[torchbearer.CRITERION]
+        if hasattr(criterion, "torchbearer_state"):
+            trial.state[torchbearer.CALLBACK_LIST].append([LossStateCallback(criterion)])
+
+        return trial
+
+    def _get_optimizer(self, module):
+        if not self.sparse_embeddings:
+            return super()._get_optimizer(module)
+
+        optimizer_params = dict(self.optimizer_params)
+        weight_decay     = optimizer_params.pop("weight_decay", 0.)
+
+        sparse_params = sparse_embedding_parameters(module)
+        if not sparse_params:
+            return super()._get_optimizer(module)
+
+        sparse_ids    = set(id(p) for p in sparse_params)
+        dense_params  = [p for p in module.parameters() if p.requires_grad and id(p) not in sparse_ids]
+
+        dense_optimizer = TORCH_OPTIMIZERS[self.optimizer](
+            dense_params, lr=self.learning_rate, weight_decay=weight_decay, **optimizer_params
+        ) if dense_params else None
+
+        return SparseDenseOptimizer(dense_optimizer,
+                                    SPARSE_OPTIMIZERS[self.sparse_optimizer](sparse_params, lr=self.learning_rate),
+                                    weight_decay=weight_decay)
+
+class TripletTraining(SupervisedTraining):
+    loss_function:  str = luigi.ChoiceParameter(choices=["relative_triplet", "contrastive_loss", "in_batch_softmax"], default="relative_triplet")
     save_item_embedding_tsv: bool = luigi.BoolParameter(default=False)
 
+    def _triplet_dataset(self, data_frame: pd.DataFrame, negative_proportion: float, data_key: str) -> Dataset:
+        # The triplet store is keyed by this task, whose id covers its inputs and parameters
+        return self.project_config.dataset_class(
+            data_frame=data_frame,
+            embeddings_for_metadata=self.embeddings_for_metadata,
+            project_config=self.project_config,
+            index_mapping=self.index_mapping,
+            negative_proportion=negative_proportion,
+            data_key=data_key,
+            store_key=self.task_id
+        )
+
+    @property
+    def train_dataset(self) -> Dataset:
+        if not hasattr(self, "_train_dataset"):
+            self._train_dataset = self._triplet_dataset(self.train_data_frame, self.negative_proportion, TRAIN_DATA)
+        return self._train_dataset
+
+    @property
+    def val_dataset(self) -> Dataset:
+        if not hasattr(self, "_val_dataset"):
+            self._val_dataset = self._triplet_dataset(self.val_data_frame, self.negative_proportion, VAL_DATA)
+        return self._val_dataset
+
+    @property
+    def test_dataset(self) -> Dataset:
+        if not hasattr(self, "_test_dataset"):
+            self._test_dataset = self._triplet_dataset(self.test_data_frame, 0.0, TEST_DATA)
+        return self._test_dataset
+
     def after_fit(self):
         if self.save_item_embedding_tsv:
             print("save_item_embedding_tsv...")
@@ -244,8 +396,12 @@ class TripletTraining(SupervisedModelTraining):
     def export_embs(self):
         module = self.get_trained_module()
 
-        item_embeddings: np.ndarray = module.item_embeddings.weight.data.cpu().numpy()
-        np.savetxt(self.output().path+"/item_embeddings.npy", item_embeddings, delimiter="\t")
+        # Chunk by chunk, never the full table of a compositional backend on the device
+        with torch.no_grad():
+            item_embeddings: np.ndarray = np.concatenate([rows.float().cpu().numpy()
+                                                          for _, rows in embedding_chunks(module.item_embeddings)])
+        save_embedding(self.output().path+"/item_embeddings.npy", item_embeddings,
+                       self.index_mapping[self.project_config.item_column.name])
 
         self.export_tsne_file(item_embeddings, None)
 
@@ -288,7 +444,4 @@ class TripletTraining(SupervisedModelTraining):
     def embeddings_for_metadata(self) -> Optional[Dict[str, np.ndarray]]:
         return self.metadata_data_frame
 
-    def _get_loss_function(self):
-        return TORCH_LOSS_FUNCTIONS[self.loss_function](**self.loss_function_params)
-
  
\ No newline at end of file
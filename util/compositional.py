@@ -0,0 +1,147 @@
+from typing import Any, Callable, Dict, Iterator, Tuple, Union
+
+import math
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+EMBEDDING_BACKENDS = ["full", "qr", "hash"]
+HASH_PRIME = 2147483647
+
+
+class QREmbedding(nn.Module):
+    '''
+    Quotient-remainder embedding: row i is the sum of row i // n_buckets of
+    the quotient table and row i % n_buckets of the remainder table, unique
+    for every i.
+
+    https://arxiv.org/abs/1909.02107
+    '''
+    def __init__(self, num_embeddings: int, embedding_dim: int, n_buckets: int):
+        super().__init__()
+        self.num_embeddings = num_embeddings
+        self.embedding_dim  = embedding_dim
+        self.n_buckets      = n_buckets
+
+        self.quotient  = nn.Embedding(int(math.ceil(num_embeddings / n_buckets)), embedding_dim)
+        self.remainder = nn.Embedding(n_buckets, embedding_dim)
+
+    def forward(self, ids: torch.Tensor) -> torch.Tensor:
+        ids = ids.long()
+        return self.quotient(ids // self.n_buckets) + self.remainder(ids % self.n_buckets)
+
+class HashEmbedding(nn.Module):
+    '''
+    Multi-hash embedding: row i is the sum of the rows of n_hashes universal
+    hashes of i into a shared table of n_buckets rows.
+    '''
+    def __init__(self, num_embeddings: int, embedding_dim: int, n_buckets: int,
+                 n_hashes: int = 2, seed: int = 42):
+        super().__init__()
+        self.num_embeddings = num_embeddings
+        self.embedding_dim  = embedding_dim
+        self.n_buckets      = n_buckets
+
+        random_state = np.random.RandomState(seed)
+        self.register_buffer("hash_a", torch.from_numpy(random_state.randint(1, HASH_PRIME, n_hashes)).long())
+        self.register_buffer("hash_b", torch.from_numpy(random_state.randint(0, HASH_PRIME, n_hashes)).long())
+
+        self.table = nn.Embedding(n_buckets, embedding_dim)
+
+    def buckets(self, ids: torch.Tensor) -> torch.Tensor:
+        return ((ids.long().unsqueeze(-1) * self.hash_a + self.hash_b) % HASH_PRIME) % self.n_buckets
+
+    def forward(self, ids: torch.Tensor) -> torch.Tensor:
+        return self.table(self.buckets(ids)).sum(-2)
+
+class EmbeddingLinear(nn.Module):
+    '''
+    nn.Linear(embedding_dim, num_embeddings) with an embedding table (of any
+    backend) as weight, read chunk_size rows at a time. With
+    init_weights=False the table keeps its weights, e.g. when tied to the
+    input item embeddings.
+    '''
+    chunk_size = 65536
+
+    def __init__(self, embedding: nn.Module, init_weights: bool = True):
+        super().__init__()
+        self.embedding = embedding
+        self.bias      = nn.Parameter(torch.zeros(embedding.num_embeddings))
+
+        if init_weights:
+            bound = 1 / math.sqrt(embedding.embedding_dim)
+            init_embedding_(self.embedding, nn.init.uniform_, -bound, bound)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return torch.cat([F.linear(x, rows, self.bias[ids])
+                            for ids, rows in embedding_chunks(self.embedding, self.chunk_size)], dim=-1)
+
+def build_embedding(num_embeddings: int, embedding_dim: int,
+                    backend: str = "full", memory: float = 1.0, n_hashes: int = 2) -> nn.Module:
+    '''
+    Item table of the given backend using about memory x the rows of the full
+    nn.Embedding (QR needs at least 2 * sqrt(num_embeddings) rows).
+    '''
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError("embedding backend must be one of {}".format(EMBEDDING_BACKENDS))
+
+    if backend == "full" or memory >= 1:
+        return nn.Embedding(num_embeddings, embedding_dim)
+
+    budget = max(int(memory * num_embeddings), 1)
+
+    if backend == "qr":
+        return QREmbedding(num_embeddings, embedding_dim,
+                           max(budget // 2, int(math.ceil(math.sqrt(num_embeddings)))))
+    else:
+        return HashEmbedding(num_embeddings, embedding_dim, budget, n_hashes)
+
+def init_embedding_(embedding: nn.Module, init: Callable, *args) -> None:
+    '''
+    Applies the nn.init function to every table of the embedding.
+    '''
+    for table in embedding.modules():
+        if isinstance(table, nn.Embedding):
+            init(table.weight.data, *args)
+
+def embedding_rows(embedding: Union[torch.Tensor, nn.Module], ids: torch.Tensor) -> torch.Tensor:
+    '''
+    Rows ids of an (I, E) table or of an embedding module of any backend.
+    '''
+    return embedding[ids] if isinstance(embedding, torch.Tensor) else embedding(ids)
+
+def embedding_chunks(embedding: Union[torch.Tensor, nn.Module],
+                     chunk_size: int = 65536) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+    '''
+    (ids, rows) of an (I, E) table or of an embedding module, chunk_size rows
+    at a time, so a compositional table is never built in full.
+    '''
+    if isinstance(embedding, torch.Tensor):
+        n_rows, device = embedding.size(0), embedding.device
+    else:
+        n_rows, device = embedding.num_embeddings, next(embedding.parameters()).device
+
+    for start in range(0, n_rows, chunk_size):
+        ids = torch.arange(start, min(start + chunk_size, n_rows), device=device)
+        yield ids, embedding_rows(embedding, ids)
+
+def embedding_memory_report(module: nn.Module) -> Dict[str, Any]:
+    '''
+    Parameters of the compositional tables of the module against the full
+    tables they replace.
+    '''
+    tables = []
+    for name, m in module.named_modules():
+        if isinstance(m, (QREmbedding, HashEmbedding)):
+            tables.append(dict(name=name, backend=type(m).__name__,
+                               parameters=sum(p.numel() for p in m.parameters()),
+                               full_parameters=m.num_embeddings * m.embedding_dim))
+
+    element_size = next(module.parameters()).element_size()
+    parameters   = sum(p.numel() for p in module.parameters())
+    saved        = sum(t["full_parameters"] - t["parameters"] for t in tables)
+
+    return dict(tables=tables, parameters=parameters, full_parameters=parameters + saved,
+                memory_mb=parameters * element_size / 2**20,
+                memory_saved_mb=saved * element_size / 2**20)
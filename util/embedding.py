@@ -0,0 +1,71 @@
+from typing import Any, Dict, Optional, Tuple
+
+import json
+import os
+import pickle
+import numpy as np
+
+NPY_MAGIC = b"\x93NUMPY"
+
+
+def embedding_meta_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".json"
+
+def save_embedding(path: str, weights: np.ndarray,
+                   id_mapping: Optional[Dict[str, int]] = None, dtype: str = "float32") -> None:
+    '''
+    Writes the weights as a real .npy file and, next to it, a JSON header
+    with dtype, shape and the item id -> row mapping, as [id, row] pairs so
+    the ids keep their type.
+    '''
+    weights = np.ascontiguousarray(weights, dtype=dtype)
+
+    with open(path, "wb") as f:
+        np.save(f, weights)
+
+    with open(embedding_meta_path(path), "w") as f:
+        json.dump(dict(dtype=str(weights.dtype), shape=list(weights.shape),
+                       id_mapping=[[k.item() if isinstance(k, np.generic) else k, int(v)]
+                                   for k, v in (id_mapping or {}).items()]), f)
+
+def load_embedding_weights(path: str, mmap: bool = True) -> Tuple[np.ndarray, Optional[Dict[str, int]]]:
+    '''
+    Returns the weights (memory-mapped read-only if mmap) and the id mapping
+    of the JSON header, if any. Text files from np.savetxt are still read.
+    '''
+    with open(path, "rb") as f:
+        is_npy = f.read(len(NPY_MAGIC)) == NPY_MAGIC
+
+    if not is_npy:
+        return np.loadtxt(path), None
+
+    weights = np.load(path, mmap_mode="r" if mmap else None)
+
+    id_mapping = None
+    if os.path.exists(embedding_meta_path(path)):
+        with open(embedding_meta_path(path)) as f:
+            id_mapping = json.load(f)["id_mapping"] or None
+
+    # Older headers stored the mapping as a dict, with the ids as strings
+    if isinstance(id_mapping, dict):
+        id_mapping = {int(k) if k.lstrip("-").isdigit() else k: v for k, v in id_mapping.items()}
+    elif id_mapping is not None:
+        id_mapping = {k: v for k, v in id_mapping}
+
+    return weights, id_mapping
+
+def load_index_mapping(path_from_index_mapping: Optional[str], id_mapping: Optional[Dict[Any, int]],
+                       column: str = "ItemID") -> Dict[str, Dict[Any, int]]:
+    '''
+    The extern index mapping pickle or, without one, the id mapping saved with
+    the embeddings. Raises if there is neither.
+    '''
+    if path_from_index_mapping and os.path.exists(path_from_index_mapping):
+        with open(path_from_index_mapping, "rb") as f:
+            return pickle.load(f)
+
+    if id_mapping is None:
+        raise ValueError("No index mapping for the embeddings: {} does not exist and they were "
+                         "saved without an id mapping".format(path_from_index_mapping))
+
+    return {column: id_mapping}
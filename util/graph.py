@@ -0,0 +1,77 @@
+from typing import List, Tuple
+
+import numpy as np
+from multiprocessing import Pool
+from scipy.sparse import csr_matrix, vstack
+
+
+def adjacency_matrix(item_a: np.ndarray, item_b: np.ndarray) -> Tuple[csr_matrix, np.ndarray]:
+    '''
+    0/1 CSR adjacency of the (item_a -> item_b) pairs over the compact
+    item space. Returns the matrix and the item id of each row/column.
+    '''
+    items, codes = np.unique(np.concatenate([item_a, item_b]), return_inverse=True)
+    rows, cols   = codes[:len(item_a)], codes[len(item_a):]
+
+    adjacency = csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(len(items), len(items)))
+    adjacency.sum_duplicates()
+    adjacency.data[:] = 1
+
+    return adjacency, items
+
+_adjacency = None # matrix of the pool workers, set once by _init_worker
+
+def _init_worker(adjacency: csr_matrix) -> None:
+    global _adjacency
+    _adjacency = adjacency
+
+def _k_hop_worker_block(args) -> csr_matrix:
+    return _k_hop_block(_adjacency, *args)
+
+def _k_hop_block(adjacency: csr_matrix, start: int, end: int, max_deep: int) -> csr_matrix:
+    # Nodes at depth 0..max_deep are expanded, so reach covers 1..max_deep+1 hops
+    reach    = adjacency[start:end]
+    frontier = reach
+    for _ in range(max_deep):
+        frontier = frontier * adjacency
+        frontier.data[:] = 1
+        frontier = (frontier - frontier.multiply(reach)).tocsr()
+        frontier.eliminate_zeros()
+        if frontier.nnz == 0:
+            break
+        reach = reach + frontier
+
+    return reach.tocsr()
+
+def k_hop_neighbours(adjacency: csr_matrix, max_deep: int,
+                     chunk_size: int = 10000, n_jobs: int = 1) -> csr_matrix:
+    '''
+    0/1 CSR matrix of the items reachable from each row in 1..max_deep+1 hops,
+    by frontier BFS over row blocks (optionally in parallel processes).
+    '''
+    blocks = [(start, min(start + chunk_size, adjacency.shape[0]), max_deep)
+              for start in range(0, adjacency.shape[0], chunk_size)]
+
+    # The matrix goes to each worker once, the tasks only carry row ranges
+    if n_jobs > 1:
+        with Pool(n_jobs, initializer=_init_worker, initargs=(adjacency,)) as p:
+            reaches = p.map(_k_hop_worker_block, blocks)
+    else:
+        reaches = [_k_hop_block(adjacency, *block) for block in blocks]
+
+    return vstack(reaches, format="csr") if reaches else adjacency
+
+def k_hop_positives(item_a: np.ndarray, item_b: np.ndarray, max_deep: int,
+                    chunk_size: int = 10000, n_jobs: int = 1) -> Tuple[np.ndarray, List[List[int]]]:
+    '''
+    For every item_a returns the sorted ids of the items reachable in
+    1..max_deep+1 hops of the co-occurrence graph.
+    '''
+    adjacency, items = adjacency_matrix(np.asarray(item_a), np.asarray(item_b))
+    reach = k_hop_neighbours(adjacency, max_deep, chunk_size=chunk_size, n_jobs=n_jobs)
+    reach.sort_indices()
+
+    sources   = np.unique(np.searchsorted(items, item_a))
+    positives = [items[reach.indices[reach.indptr[i]:reach.indptr[i + 1]]].tolist() for i in sources]
+
+    return items[sources], positives
@@ -0,0 +1,75 @@
+from typing import Any, Dict, List, Optional
+
+import torch
+import torch.nn as nn
+from torch.optim.optimizer import Optimizer
+
+
+def sparse_embedding_parameters(module: nn.Module) -> List[nn.Parameter]:
+    '''
+    Switches every trainable nn.Embedding of the module to sparse gradients
+    and returns their weights.
+    '''
+    params = []
+    for m in module.modules():
+        if isinstance(m, nn.Embedding) and m.weight.requires_grad:
+            m.sparse = True
+            params.append(m.weight)
+
+    return params
+
+class SparseDenseOptimizer(object):
+    '''
+    Steps the embedding tables with sparse_optimizer (SparseAdam, Adagrad),
+    which only touches the rows looked up in the batch, and every other
+    parameter with dense_optimizer. weight_decay is applied lazily, to the
+    looked up rows only.
+
+    A table also used outside lookups (e.g. as output layer) gets a dense
+    gradient, stepped as a sparse one over its non-zero rows.
+    '''
+    def __init__(self, dense_optimizer: Optional[Optimizer], sparse_optimizer: Optimizer, weight_decay: float = 0.):
+        self.dense_optimizer  = dense_optimizer
+        self.sparse_optimizer = sparse_optimizer
+        self.weight_decay     = weight_decay
+        self.optimizers       = [o for o in (dense_optimizer, sparse_optimizer) if o is not None]
+
+    @property
+    def param_groups(self) -> List[Dict[str, Any]]:
+        return [group for o in self.optimizers for group in o.param_groups]
+
+    @property
+    def state(self) -> Dict[torch.Tensor, Any]:
+        return {p: state for o in self.optimizers for p, state in o.state.items()}
+
+    def zero_grad(self) -> None:
+        for o in self.optimizers:
+            o.zero_grad()
+
+    def step(self, closure=None):
+        loss = closure() if closure is not None else None
+
+        for group in self.sparse_optimizer.param_groups:
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+
+                grad = p.grad if p.grad.is_sparse else p.grad.to_sparse(1)
+                grad = grad.coalesce()
+                if self.weight_decay:
+                    grad._values().add_(p.data[grad._indices()[0]], alpha=self.weight_decay)
+                p.grad = grad
+
+        for o in self.optimizers:
+            o.step()
+
+        return loss
+
+    def state_dict(self) -> Dict[str, Any]:
+        return dict(dense=self.dense_optimizer.state_dict() if self.dense_optimizer else None,
+                    sparse=self.sparse_optimizer.state_dict())
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        if self.dense_optimizer:
+            self.dense_optimizer.load_state_dict(state_dict["dense"])
+        self.sparse_optimizer.load_state_dict(state_dict["sparse"])
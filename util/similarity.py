@@ -0,0 +1,57 @@
+import numpy as np
+from multiprocessing import Pool
+from scipy.sparse import csr_matrix, vstack
+from sklearn.preprocessing import normalize
+
+
+_normalized = None # matrix of the pool workers, set once by _init_worker
+
+def _init_worker(normalized: csr_matrix) -> None:
+    global _normalized
+    _normalized = normalized
+
+def _top_k_worker_block(args) -> csr_matrix:
+    return _top_k_block(_normalized, *args)
+
+def _top_k_block(normalized: csr_matrix, start: int, end: int, k: int) -> csr_matrix:
+    # Sparse-sparse cosine of the block rows against every row
+    sim = (normalized[start:end] * normalized.T).tocsr()
+    sim.eliminate_zeros()
+
+    indptr, indices, data = [0], [], []
+    for i in range(sim.shape[0]):
+        row_indices = sim.indices[sim.indptr[i]:sim.indptr[i + 1]]
+        row_data    = sim.data[sim.indptr[i]:sim.indptr[i + 1]]
+
+        if len(row_data) > k:
+            top = np.argpartition(-row_data, k - 1)[:k]
+            row_indices, row_data = row_indices[top], row_data[top]
+
+        indices.append(row_indices)
+        data.append(row_data)
+        indptr.append(indptr[-1] + len(row_data))
+
+    return csr_matrix((np.concatenate(data) if data else np.zeros(0, dtype=sim.dtype),
+                       np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32),
+                       np.array(indptr)), shape=(end - start, sim.shape[1]))
+
+def top_k_cosine_similarity(matrix: csr_matrix, k: int,
+                            chunk_size: int = 1000, n_jobs: int = 1) -> csr_matrix:
+    '''
+    CSR matrix with, for each row, its cosine similarity to the k most
+    similar rows (itself included), computed over row blocks (optionally in
+    parallel processes) so the dense rows x rows matrix is never built.
+    '''
+    normalized = normalize(csr_matrix(matrix, dtype=np.float32), norm="l2", axis=1)
+
+    blocks = [(start, min(start + chunk_size, normalized.shape[0]), k)
+              for start in range(0, normalized.shape[0], chunk_size)]
+
+    # The matrix goes to each worker once, the tasks only carry row ranges
+    if n_jobs > 1:
+        with Pool(n_jobs, initializer=_init_worker, initargs=(normalized,)) as p:
+            sims = p.map(_top_k_worker_block, blocks)
+    else:
+        sims = [_top_k_block(normalized, *block) for block in blocks]
+
+    return vstack(sims, format="csr") if sims else csr_matrix((0, normalized.shape[0]), dtype=np.float32)